@@ -0,0 +1,132 @@
+"""
+Append-only archive of forecast slots and their scores.
+
+Every record is a fixed-width little-endian struct, and records are appended
+to one chunk file per day (YYYYMMDD.bin, or YYYYMMDD-<suffix>.bin for chunks
+uploaded by separate runs). Chunks are read through mmap, so a query only
+touches the days it asks for and never loads a whole chunk into memory.
+"""
+import datetime
+import mmap
+import pathlib
+import struct
+import typing
+import zlib
+
+LEG_DEPARTURE = 0
+LEG_RETURN = 1
+LEG_BEST_DEPARTURE = 2
+LEG_BEST_RETURN = 3
+# a fetched forecast slot, once per midway point and day; subscriber 0, no scores
+LEG_FORECAST = 4
+
+
+class ArchiveRecord(typing.NamedTuple):
+    day: int  # YYYYMMDD
+    dt: int  # timestamp of the forecast slot
+    subscriber: int  # subscription, see subscriber_id
+    leg: int  # one of the LEG_* constants
+    lat: float  # midway point
+    lon: float  # midway point
+    travel_direction: float
+    clouds: float
+    humidity: float
+    rain: float
+    temp_min: float
+    temp_max: float
+    wind_speed: float
+    wind_deg: float
+    score_temp: float
+    score_wind: float
+    score_rain: float
+    score_clouds: float
+
+
+RECORD = struct.Struct('<IIIBddffffffffffff')
+
+
+def subscriber_id(key: str) -> int:
+    """
+    Id of one subscription, from Subscription.key, so that several routes
+    under the same email are told apart.
+    """
+    return zlib.crc32(key.encode('utf-8'))
+
+
+def day_from_date(date: datetime.date) -> int:
+    return date.year * 10000 + date.month * 100 + date.day
+
+
+def pack(records: typing.Iterable[ArchiveRecord]) -> bytes:
+    return b''.join(RECORD.pack(*record) for record in records)
+
+
+class Archive:
+    def __init__(self, path: typing.Union[str, pathlib.Path]):
+        self.path = pathlib.Path(path)
+
+    def append(self, records: typing.Iterable[ArchiveRecord]):
+        """
+        Appends records to the chunk for their day.
+        """
+        by_day = {}
+        for record in records:
+            by_day.setdefault(record.day, []).append(record)
+        self.path.mkdir(parents=True, exist_ok=True)
+        for day, day_records in by_day.items():
+            with open(self.path / f'{day}.bin', 'ab') as f:
+                f.write(pack(day_records))
+
+    def get_chunks(self, start: typing.Optional[int] = None, end: typing.Optional[int] = None):
+        """
+        Chunk files whose day falls within [start, end], oldest first.
+        """
+        chunks = []
+        for chunk in sorted(self.path.glob('*.bin')):
+            day = int(chunk.stem[:8])
+            if start is not None and day < start:
+                continue
+            if end is not None and day > end:
+                continue
+            chunks.append(chunk)
+        return chunks
+
+    def query(
+            self,
+            start: typing.Optional[datetime.date] = None,
+            end: typing.Optional[datetime.date] = None,
+            lat_range: typing.Optional[typing.Tuple[float, float]] = None,
+            lon_range: typing.Optional[typing.Tuple[float, float]] = None,
+            subscribers: typing.Optional[typing.Iterable[int]] = None,
+            legs: typing.Optional[typing.Iterable[int]] = None) -> typing.Iterator[ArchiveRecord]:
+        """
+        Yields records between the start and end dates (inclusive), with a
+        midway point inside the lat/lon ranges, for the given subscriber ids
+        and legs. Any filter left as None matches everything.
+        """
+        if subscribers is not None:
+            subscribers = set(subscribers)
+        if legs is not None:
+            legs = set(legs)
+        chunks = self.get_chunks(
+            start=day_from_date(start) if start is not None else None,
+            end=day_from_date(end) if end is not None else None)
+
+        for chunk in chunks:
+            with open(chunk, 'rb') as f:
+                if f.seek(0, 2) < RECORD.size:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m, memoryview(m) as view:
+                    # ignore a trailing partial record from an interrupted append
+                    usable = len(view) - len(view) % RECORD.size
+                    for values in RECORD.iter_unpack(view[:usable]):
+                        record = ArchiveRecord._make(values)
+                        if subscribers is not None and record.subscriber not in subscribers:
+                            continue
+                        if legs is not None and record.leg not in legs:
+                            continue
+                        if lat_range is not None and not lat_range[0] <= record.lat <= lat_range[1]:
+                            continue
+                        if lon_range is not None and not lon_range[0] <= record.lon <= lon_range[1]:
+                            continue
+                        yield record
@@ -1,19 +1,47 @@
+import archive
+import bisect
 import boto3
+import concurrent.futures
 import dataclasses
 import datetime
+import hashlib
 import json
 import logging
+import mail
 import math
-import smtplib
+import profiling
+import re
+import threading
 import typing
 from botocore.vendored import requests
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from pipeline import Pipeline, Stage
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 IDEAL_TEMPERATURE_RANGE = range(13, 25)
+FORECAST_SLOT_SECONDS = 3 * 60 * 60
+
+# workers per pipeline stage; fetch and send mostly wait on the network
+PIPELINE_WORKERS = {
+    "fetch": 4,
+    "score": 1,
+    "render": 1,
+    "send": 2,
+}
+PIPELINE_QUEUE_SIZE = 16
+
+PROFILE_DESTINATION = 's3://bikeride-forecast/profiles'
+
+EMAIL_SUBJECT = "BikeRideForecast: Your Daily Report"
+# 'smtp' or 'ses'; see create_transport
+MAIL_TRANSPORT = 'smtp'
+SES_TEMPLATE_NAME = 'BikeRideForecastDailyReport'
+
+# subscriptions per chunk handed to a worker process
+RENDER_CHUNK_SIZE = 50
 
 
 def get_store():
@@ -24,6 +52,17 @@ def get_store():
     return store
 
 
+def save_archive_chunk(records: typing.Sequence[archive.ArchiveRecord]):
+    """
+    Uploads one run's records as its own chunk, so runs never overwrite each other.
+    """
+    now = datetime.datetime.now()
+    key = f'archive/{archive.day_from_date(now)}-{now.strftime("%H%M%S")}.bin'
+    s3 = boto3.client("s3")
+    s3.put_object(Bucket='bikeride-forecast', Key=key, Body=archive.pack(records))
+    logger.info("Archived %d records to %s", len(records), key)
+
+
 def get_secrets():
     s3 = boto3.client("s3")
     res = s3.get_object(Bucket='bikeride-forecast', Key='secrets.json')
@@ -68,6 +107,29 @@ def calc_degrees_north_from_coords(pointA: tuple, pointB: tuple) -> float:
     return round(deg, 2)
 
 
+def is_valid_time(time) -> bool:
+    """
+    Whether time is an int formatted as HHMM, e.g. 930 == 09:30
+    """
+    return isinstance(time, int) and not isinstance(time, bool) \
+        and 0 <= time // 100 < 24 and 0 <= time % 100 < 60
+
+
+def get_datetime_for_time(day: datetime.datetime, time: int) -> datetime.datetime:
+    """
+    Combines a day with a time formatted as an int, e.g. 930 == 09:30
+    """
+    hour = int(time / 100)
+    minute = int(time - hour * 100)
+    return datetime.datetime(
+        year=day.year,
+        month=day.month,
+        day=day.day,
+        hour=hour,
+        minute=minute,
+        second=0)
+
+
 def get_weather_data(coords: tuple) -> typing.Mapping:
     logger.debug('Getting weather data for %s', coords)
     secrets = get_secrets()
@@ -126,6 +188,80 @@ class Weather:
                 }
         return cls.create_from_weather_data(closest_item['item'])
 
+    @classmethod
+    def get_closest(cls, forecast: typing.Sequence['Weather'], time: datetime.datetime):
+        """
+        Same as get_weather_at_time, for an already parsed forecast.
+        """
+        dt = time.timestamp()
+        return min(forecast, key=lambda weather: abs(weather.dt - dt))
+
+    @classmethod
+    def list_from_weather_data(cls, weather_data: dict) -> typing.Tuple['Weather', ...]:
+        """
+        Parses every slot in the forecast once, so that it can be scanned
+        repeatedly without going back to the raw response.
+        """
+        return tuple(
+            cls.create_from_weather_data(item)
+            for item in weather_data["list"])
+
+    def to_archive_record(self, day: datetime.date, point: tuple) -> archive.ArchiveRecord:
+        return archive.ArchiveRecord(
+            day=archive.day_from_date(day),
+            dt=self.dt,
+            subscriber=0,
+            leg=archive.LEG_FORECAST,
+            lat=point[0],
+            lon=point[1],
+            travel_direction=0,
+            clouds=self.clouds,
+            humidity=self.humidity,
+            rain=self.rain,
+            temp_min=self.temp.min,
+            temp_max=self.temp.max,
+            wind_speed=self.wind.speed,
+            wind_deg=self.wind.deg,
+            score_temp=0,
+            score_wind=0,
+            score_rain=0,
+            score_clouds=0)
+
+    @classmethod
+    def from_archive_record(cls, record: archive.ArchiveRecord):
+        return cls(
+            clouds=record.clouds,
+            dt=record.dt,
+            humidity=record.humidity,
+            rain=record.rain,
+            temp=Temp(min=record.temp_min, max=record.temp_max),
+            wind=Wind(speed=record.wind_speed, deg=record.wind_deg))
+
+    def to_row(self) -> tuple:
+        """
+        Flat tuple of primitives, which pickles much smaller than the dataclasses.
+        """
+        return (
+            self.clouds,
+            self.dt,
+            self.humidity,
+            self.rain,
+            self.temp.min,
+            self.temp.max,
+            self.wind.speed,
+            self.wind.deg)
+
+    @classmethod
+    def from_row(cls, row: tuple):
+        clouds, dt, humidity, rain, temp_min, temp_max, wind_speed, wind_deg = row
+        return cls(
+            clouds=clouds,
+            dt=dt,
+            humidity=humidity,
+            rain=rain,
+            temp=Temp(min=temp_min, max=temp_max),
+            wind=Wind(speed=wind_speed, deg=wind_deg))
+
     @classmethod
     def create_from_weather_data(cls, data: dict):
         if 'wind' in data:
@@ -168,6 +304,9 @@ class Subscription:
     dest: typing.Sequence[float]
     departure_time: int
     return_time: int
+    best_window: bool = False
+    departure_window: typing.Optional[typing.Sequence[int]] = None  # (earliest, latest)
+    return_window: typing.Optional[typing.Sequence[int]] = None  # (earliest, latest)
 
     @classmethod
     def from_data(cls, data):
@@ -177,6 +316,13 @@ class Subscription:
         assert isinstance(data['return_time'], int)
         assert len(data['home']) == 2, 'Invalid home coords'
         assert len(data['dest']) == 2, 'Invalid dest coords'
+        assert isinstance(data.get('best_window', False), bool)
+        for key in ('departure_window', 'return_window'):
+            window = data.get(key)
+            assert window is None or (
+                len(window) == 2
+                and all(is_valid_time(time) for time in window)
+                and window[0] <= window[1]), f'Invalid {key}'
 
         return cls(
             name=data['name'],
@@ -184,7 +330,10 @@ class Subscription:
             home=data['home'],
             dest=data['dest'],
             departure_time=data['departure_time'],
-            return_time=data['return_time'])
+            return_time=data['return_time'],
+            best_window=data.get('best_window', False),
+            departure_window=data.get('departure_window'),
+            return_window=data.get('return_window'))
 
     def to_serializable(self):
         return {
@@ -194,8 +343,17 @@ class Subscription:
             "dest": self.dest,
             "departure_time": self.departure_time,
             "return_time": self.return_time,
+            "best_window": self.best_window,
+            "departure_window": self.departure_window,
+            "return_window": self.return_window,
         }
 
+    def key(self) -> str:
+        """
+        Tells apart several subscriptions for the same email, e.g. two routes.
+        """
+        return hashlib.sha1(json.dumps(self.to_serializable(), sort_keys=True).encode('utf-8')).hexdigest()
+
 
 @dataclasses.dataclass(frozen=True)
 class SuckReport:
@@ -230,18 +388,38 @@ class SuckReport:
             pointA: tuple,
             pointB: tuple):
         direction = calc_degrees_north_from_coords(pointA, pointB)
-        hour = int(time / 100)
-        minute = int(time - hour * 100)
-        date = datetime.datetime(
-            year=day.year,
-            month=day.month,
-            day=day.day,
-            hour=hour,
-            minute=minute,
-            second=0)
+        date = get_datetime_for_time(day, time)
         weather = Weather.get_weather_at_time(weather_data, date)
         return cls.create(weather, direction)
 
+    def to_archive_record(
+            self,
+            day: datetime.date,
+            key: str,
+            leg: int,
+            point: tuple) -> archive.ArchiveRecord:
+        """
+        key is the Subscription.key of the subscriber.
+        """
+        return self.weather.to_archive_record(day, point)._replace(
+            subscriber=archive.subscriber_id(key),
+            leg=leg,
+            travel_direction=self.travel_direction,
+            score_temp=self.temp,
+            score_wind=self.wind,
+            score_rain=self.rain,
+            score_clouds=self.clouds)
+
+    @classmethod
+    def get_total_score(cls, weather: Weather, travel_direction: float) -> float:
+        """
+        Same total as create(...).total, without building a report.
+        """
+        return (
+            cls.get_temp_score(weather.temp, weather.humidity)
+            + cls.get_wind_score(weather.wind, travel_direction)
+            + cls.get_rain_score(weather.rain))
+
     @classmethod
     def get_rain_score(cls, rain: float):
         """any rain sucks."""
@@ -306,153 +484,673 @@ class SuckReport:
         return round(score, 2)
 
 
-def create_email_contents(sub: Subscription, departure_report: SuckReport, return_report: SuckReport) -> (str, str):
-    text = f"Hey {sub.name}!" \
-           f"\tTotal suckiness for departure at {sub.departure_time}: {departure_report.total}" \
-           f"\t\tWind: {departure_report.wind}" \
-           f"\t\tTemp: {departure_report.temp}" \
-           f"\t\tRain: {departure_report.rain}" \
-           f"\t\tClouds: {departure_report.clouds}" \
-           f"\tTotal suckiness for return at {sub.return_time}: {return_report.total}" \
-           f"\t\tWind: {return_report.wind}" \
-           f"\t\tTemp: {return_report.temp}" \
-           f"\t\tRain: {return_report.rain}" \
-           f"\t\tClouds: {return_report.clouds}" \
-           f"\nReminder: < 5 is great; 5-10 is fine; 11-15 sucks; 16-20 is horrendous; 21+ is a legendary failure."
-
-    html = """\
+@dataclasses.dataclass(frozen=True)
+class BestWindow:
+    departure_report: SuckReport
+    return_report: SuckReport
+
+    @property
+    def total(self) -> float:
+        return self.departure_report.total + self.return_report.total
+
+    @property
+    def departure_time(self) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(self.departure_report.weather.dt)
+
+    @property
+    def return_time(self) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(self.return_report.weather.dt)
+
+    @classmethod
+    def get_slots_in_window(
+            cls,
+            forecast: typing.Sequence[Weather],
+            day: datetime.datetime,
+            window: typing.Optional[typing.Sequence[int]]):
+        """
+        Without a window, every slot in the forecast horizon is a candidate.
+        Otherwise a slot is a candidate if its 3 hours overlap the window.
+        """
+        if window is None:
+            return forecast
+        half_slot = FORECAST_SLOT_SECONDS / 2
+        start = get_datetime_for_time(day, window[0]).timestamp() - half_slot
+        end = get_datetime_for_time(day, window[1]).timestamp() + half_slot
+        return [weather for weather in forecast if start <= weather.dt <= end]
+
+    @classmethod
+    def find(
+            cls,
+            forecast: typing.Sequence[Weather],
+            day: datetime.datetime,
+            pointA: tuple,
+            pointB: tuple,
+            departure_window: typing.Optional[typing.Sequence[int]] = None,
+            return_window: typing.Optional[typing.Sequence[int]] = None):
+        """
+        Finds the departure and return slots with the lowest combined suck,
+        where the return leg (pointB -> pointA) comes later on the same day
+        as the departure. Only scores are computed while scanning; reports are built for the
+        winning pair alone. Returns None if no pair of slots fits.
+        """
+        outbound = calc_degrees_north_from_coords(pointA, pointB)
+        inbound = calc_degrees_north_from_coords(pointB, pointA)
+
+        returns = sorted(
+            cls.get_slots_in_window(forecast, day, return_window),
+            key=lambda weather: weather.dt)
+        if not returns:
+            return None
+        return_dts = [weather.dt for weather in returns]
+        return_dates = [datetime.date.fromtimestamp(dt) for dt in return_dts]
+
+        # best_returns[i] == lowest-scoring return slot at or after returns[i]
+        # on the same day as returns[i]
+        best_returns = [None] * len(returns)
+        best = None
+        for i in range(len(returns) - 1, -1, -1):
+            if i + 1 < len(returns) and return_dates[i] != return_dates[i + 1]:
+                best = None
+            score = SuckReport.get_total_score(returns[i], inbound)
+            if best is None or score < best[0]:
+                best = (score, returns[i])
+            best_returns[i] = best
+
+        winner = None
+        for weather in cls.get_slots_in_window(forecast, day, departure_window):
+            i = bisect.bisect_right(return_dts, weather.dt)
+            if i == len(returns) or return_dates[i] != datetime.date.fromtimestamp(weather.dt):
+                continue
+            return_score, return_weather = best_returns[i]
+            score = SuckReport.get_total_score(weather, outbound) + return_score
+            if winner is None or score < winner[0]:
+                winner = (score, weather, return_weather)
+
+        if winner is None:
+            return None
+        return cls(
+            departure_report=SuckReport.create(winner[1], outbound),
+            return_report=SuckReport.create(winner[2], inbound))
+
+
+# Handlebars templates, filled in with create_template_data: by SES for
+# templated transports, and by render_template for everything else.
+EMAIL_TEMPLATE_TEXT = \
+    "Hey {{sub.name}}!" \
+    "\tTotal suckiness for departure at {{sub.departure_time}}: {{departure_report.total}}" \
+    "\t\tWind: {{departure_report.wind}}" \
+    "\t\tTemp: {{departure_report.temp}}" \
+    "\t\tRain: {{departure_report.rain}}" \
+    "\t\tClouds: {{departure_report.clouds}}" \
+    "\tTotal suckiness for return at {{sub.return_time}}: {{return_report.total}}" \
+    "\t\tWind: {{return_report.wind}}" \
+    "\t\tTemp: {{return_report.temp}}" \
+    "\t\tRain: {{return_report.rain}}" \
+    "\t\tClouds: {{return_report.clouds}}" \
+    "{{#if best_window}}\tBest window: depart {{best_window.departure_at}} ({{best_window.departure_total}})," \
+    " return {{best_window.return_at}} ({{best_window.return_total}}){{/if}}" \
+    "\nReminder: < 5 is great; 5-10 is fine; 11-15 sucks; 16-20 is horrendous; 21+ is a legendary failure."
+
+EMAIL_TEMPLATE_HTML = """\
     <html>
     <head></head>
     <body>
-        <h1>Hey {sub.name}!</h1>
-        <h3>Departure at {sub.departure_time}, traveling at {departure_report.travel_direction} degrees north</h3>
-        <h4>Total suckiness: {departure_report.total} points</h4>
+        <h1>Hey {{sub.name}}!</h1>
+        <h3>Departure at {{sub.departure_time}}, traveling at {{departure_report.travel_direction}} degrees north</h3>
+        <h4>Total suckiness: {{departure_report.total}} points</h4>
         <ul>
             <li>
-                Wind: {departure_report.wind} points
+                Wind: {{departure_report.wind}} points
                 <ul>
-                    <li>Speed: {departure_report.weather.wind.speed} km/hour</li>
-                    <li>Direction: {departure_report.weather.wind.deg} degrees north</li>
+                    <li>Speed: {{departure_report.weather.wind.speed}} km/hour</li>
+                    <li>Direction: {{departure_report.weather.wind.deg}} degrees north</li>
                 </ul>
             </li>
             <li>
-                Temp: {departure_report.temp} points
+                Temp: {{departure_report.temp}} points
                 <ul>
-                    <li>Min: {departure_report.weather.temp.min} degrees Celcius</li>
-                    <li>Max: {departure_report.weather.temp.max} degrees Celcius</li>
-                    <li>Humidity: {departure_report.weather.humidity}%</li>
+                    <li>Min: {{departure_report.weather.temp.min}} degrees Celcius</li>
+                    <li>Max: {{departure_report.weather.temp.max}} degrees Celcius</li>
+                    <li>Humidity: {{departure_report.weather.humidity}}%</li>
                 </ul>
             </li>
             <li>
-                Rain: {departure_report.rain} points
+                Rain: {{departure_report.rain}} points
                 <ul>
-                    <li>{departure_report.weather.rain} mm/3h</li>
+                    <li>{{departure_report.weather.rain}} mm/3h</li>
                 </ul>
             </li>
             <li>
-                Clouds: {departure_report.clouds} points
+                Clouds: {{departure_report.clouds}} points
                 <ul>
-                    <li>{departure_report.weather.clouds}%</li>
+                    <li>{{departure_report.weather.clouds}}%</li>
                 </ul>
             </li>
         </ul>
-        <h3>Return at {sub.return_time}, traveling at {return_report.travel_direction} degrees north</h3>
-        <h4>Total suckiness: {return_report.total} points</h4>
+        <h3>Return at {{sub.return_time}}, traveling at {{return_report.travel_direction}} degrees north</h3>
+        <h4>Total suckiness: {{return_report.total}} points</h4>
         <ul>
             <li>
-                Wind: {return_report.wind} points
+                Wind: {{return_report.wind}} points
                 <ul>
-                    <li>Speed: {return_report.weather.wind.speed} km/hour</li>
-                    <li>Direction: {return_report.weather.wind.deg} degrees north</li>
+                    <li>Speed: {{return_report.weather.wind.speed}} km/hour</li>
+                    <li>Direction: {{return_report.weather.wind.deg}} degrees north</li>
                 </ul>
             </li>
             <li>
-                Temp: {return_report.temp} points
+                Temp: {{return_report.temp}} points
                 <ul>
-                    <li>Min: {return_report.weather.temp.min} degrees Celcius</li>
-                    <li>Max: {return_report.weather.temp.max} degrees Celcius</li>
-                    <li>Humidity: {return_report.weather.humidity}%</li>
+                    <li>Min: {{return_report.weather.temp.min}} degrees Celcius</li>
+                    <li>Max: {{return_report.weather.temp.max}} degrees Celcius</li>
+                    <li>Humidity: {{return_report.weather.humidity}}%</li>
                 </ul>
             </li>
             <li>
-                Rain: {return_report.rain} points
+                Rain: {{return_report.rain}} points
                 <ul>
-                    <li>{return_report.weather.rain} mm/3h</li>
+                    <li>{{return_report.weather.rain}} mm/3h</li>
                 </ul>
             </li>
             <li>
-                Clouds: {return_report.clouds} points
+                Clouds: {{return_report.clouds}} points
                 <ul>
-                    <li>{return_report.weather.clouds}%</li>
+                    <li>{{return_report.weather.clouds}}%</li>
                 </ul>
             </li>
         </ul>
+        {{#if best_window}}
+        <h3>Best window: {{best_window.total}} points</h3>
+        <ul>
+            <li>Depart {{best_window.departure_at}}: {{best_window.departure_total}} points</li>
+            <li>Return {{best_window.return_at}}: {{best_window.return_total}} points</li>
+        </ul>
+        {{/if}}
         <br>
         <em>Reminder for point totals: < 5 is great; 5-10 is fine; 11-15 sucks; 16-20 is horrendous; 21+ is a legendary failure.</em>
     </body>
     </html>
-    """.format(
-        sub=sub,
-        departure_report=departure_report,
-        return_report=return_report
-    )
+    """
+
 
-    return (text, html)
+_TEMPLATE_TAG = re.compile(r'{{#if ([\w.]+)}}(.*?){{/if}}|{{([\w.]+)}}', re.DOTALL)
+_HTML_ESCAPES = str.maketrans({
+    '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#x27;', '`': '&#x60;', '=': '&#x3D;'})
 
 
-def send_email(
+def render_template(template: str, data: typing.Mapping, escape: bool = False) -> str:
+    """
+    Fills in the part of Handlebars that the email templates use:
+    {{path.to.value}}, escaped like Handlebars does with escape, and
+    {{#if path}}...{{/if}} without nesting.
+    """
+    def lookup(path: str):
+        value = data
+        for part in path.split('.'):
+            if not isinstance(value, typing.Mapping) or part not in value:
+                return None
+            value = value[part]
+        return value
+
+    def replace(match) -> str:
+        if match.group(1) is not None:
+            return render_template(match.group(2), data, escape) if lookup(match.group(1)) else ''
+        value = lookup(match.group(3))
+        text = '' if value is None else str(value)
+        return text.translate(_HTML_ESCAPES) if escape else text
+
+    return _TEMPLATE_TAG.sub(replace, template)
+
+
+def create_email_contents(
         sub: Subscription,
         departure_report: SuckReport,
-        return_report: SuckReport):
-    logger.info('Sending email to %s!', sub.email)
-    secrets = get_secrets()
-    text, html = create_email_contents(sub, departure_report, return_report)
+        return_report: SuckReport,
+        best_window: typing.Optional[BestWindow] = None) -> (str, str):
+    data = create_template_data(sub, departure_report, return_report, best_window)
+    return (
+        render_template(EMAIL_TEMPLATE_TEXT, data),
+        render_template(EMAIL_TEMPLATE_HTML, data, escape=True))
+
+
+def create_message(
+        sub: Subscription,
+        departure_report: SuckReport,
+        return_report: SuckReport,
+        best_window: typing.Optional[BestWindow],
+        from_address: str) -> MIMEMultipart:
+    text, html = create_email_contents(
+        sub, departure_report, return_report, best_window)
 
-    from_address = secrets['email_user']
     msg = MIMEMultipart('alternative')
-    msg['Subject'] = "BikeRideForecast: Your Daily Report"
+    msg['Subject'] = EMAIL_SUBJECT
     msg['From'] = from_address
     msg['To'] = sub.email
     msg.attach(MIMEText(text, 'plain'))
     msg.attach(MIMEText(html, 'html'))
+    return msg
 
-    smtp = smtplib.SMTP('smtp.gmail.com', 587)
-    smtp.set_debuglevel(0)
-    smtp.ehlo()
-    smtp.starttls()
-    smtp.ehlo()
-    smtp.login(from_address, secrets["email_pass"])
-    smtp.sendmail(from_address, sub.email, msg.as_string())
-    smtp.quit()
-    logger.info('Sent email to %s!', sub.email)
 
+def create_template_data(
+        sub: Subscription,
+        departure_report: SuckReport,
+        return_report: SuckReport,
+        best_window: typing.Optional[BestWindow] = None) -> dict:
+    """
+    Per-recipient data for EMAIL_TEMPLATE_TEXT and EMAIL_TEMPLATE_HTML.
+    Numbers are formatted by Python up front, so that a template rendered
+    by SES reads the same as one rendered by render_template.
+    """
+    data = {
+        "sub": sub.to_serializable(),
+        "departure_report": {**dataclasses.asdict(departure_report), "total": departure_report.total},
+        "return_report": {**dataclasses.asdict(return_report), "total": return_report.total},
+    }
+    if best_window is not None:
+        data["best_window"] = {
+            "total": best_window.total,
+            "departure_at": best_window.departure_time.strftime('%a %H:%M'),
+            "departure_total": best_window.departure_report.total,
+            "return_at": best_window.return_time.strftime('%a %H:%M'),
+            "return_total": best_window.return_report.total,
+        }
+    return _format_numbers(data)
 
-def send_notifications():
-    logger.info('Sending notifications!')
-    store = get_store()
-    for subscription_data in store:
-        sub = Subscription.from_data(subscription_data)
+
+def _format_numbers(value):
+    if isinstance(value, dict):
+        return {key: _format_numbers(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_format_numbers(item) for item in value]
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    return value
+
+
+def create_transport(name: str, secrets: typing.Mapping) -> mail.MailTransport:
+    if name == 'smtp':
+        return mail.SMTPTransport(secrets['email_user'], secrets['email_pass'])
+    if name == 'ses':
+        transport = mail.SESBulkTransport(secrets['email_user'], SES_TEMPLATE_NAME)
+        transport.ensure_template(EMAIL_SUBJECT, EMAIL_TEMPLATE_TEXT, EMAIL_TEMPLATE_HTML)
+        return transport
+    raise ValueError(f'Unknown mail transport {name}')
+
+
+def get_midway_point(home: typing.Sequence[float], dest: typing.Sequence[float]) -> tuple:
+    return (
+        round((home[0] + dest[0]) / 2, 6),
+        round((home[1] + dest[1]) / 2, 6)
+    )
+
+
+class ForecastCache:
+    """
+    Fetches and parses the forecast for each midway point once, even when
+    several fetch workers ask for the same point at the same time.
+    """
+
+    def __init__(self, fetch: typing.Callable[[tuple], typing.Mapping] = None):
+        self.fetch = fetch or get_weather_data
+        self._lock = threading.Lock()
+        self._futures = {}
+
+    def get(self, point: tuple) -> typing.Tuple[Weather, ...]:
+        with self._lock:
+            future = self._futures.get(point)
+            is_owner = future is None
+            if is_owner:
+                future = self._futures[point] = concurrent.futures.Future()
+        if is_owner:
+            try:
+                future.set_result(Weather.list_from_weather_data(self.fetch(point)))
+            except Exception as exc:
+                future.set_exception(exc)
+        return future.result()
+
+    def items(self) -> typing.List[typing.Tuple[tuple, typing.Tuple[Weather, ...]]]:
+        """
+        (point, forecast) for every point fetched successfully so far.
+        """
+        with self._lock:
+            futures = list(self._futures.items())
+        return [
+            (point, future.result())
+            for point, future in futures
+            if future.done() and future.exception() is None
+        ]
+
+
+def create_forecast_archive_records(
+        day: datetime.date,
+        forecasts: typing.Iterable[typing.Tuple[tuple, typing.Sequence[Weather]]]) -> typing.List[archive.ArchiveRecord]:
+    """
+    One LEG_FORECAST record per slot of each (midway point, forecast).
+    """
+    return [
+        weather.to_archive_record(day, point)
+        for point, forecast in forecasts
+        for weather in forecast
+    ]
+
+
+@dataclasses.dataclass(frozen=True)
+class Trip:
+    sub: Subscription
+    midway_point: tuple
+    forecast: typing.Tuple[Weather, ...]
+
+
+@dataclasses.dataclass(frozen=True)
+class ScoredTrip:
+    sub: Subscription
+    midway_point: tuple
+    departure_report: SuckReport
+    return_report: SuckReport
+    best_window: typing.Optional[BestWindow]
+
+    @classmethod
+    def create(cls, trip: Trip, day: datetime.datetime):
+        sub = trip.sub
         home = tuple(sub.home)
         dest = tuple(sub.dest)
-        midway_point = (
-            round((home[0] + dest[0]) / 2, 6),
-            round((home[1] + dest[1]) / 2, 6)
-        )
-        weather_data = get_weather_data(midway_point)
-        departure_report = SuckReport.create_for_trip(
-            weather_data=weather_data,
-            day=datetime.datetime.today(),
-            time=sub.departure_time,
-            pointA=home,
-            pointB=dest)
-        return_report = SuckReport.create_for_trip(
-            weather_data=weather_data,
-            day=datetime.datetime.today(),
-            time=sub.return_time,
-            pointA=dest,
-            pointB=home)
-        send_email(sub, departure_report, return_report)
+        departure_report = SuckReport.create(
+            Weather.get_closest(trip.forecast, get_datetime_for_time(day, sub.departure_time)),
+            calc_degrees_north_from_coords(home, dest))
+        return_report = SuckReport.create(
+            Weather.get_closest(trip.forecast, get_datetime_for_time(day, sub.return_time)),
+            calc_degrees_north_from_coords(dest, home))
+        best_window = None
+        if sub.best_window:
+            best_window = BestWindow.find(
+                forecast=trip.forecast,
+                day=day,
+                pointA=home,
+                pointB=dest,
+                departure_window=sub.departure_window,
+                return_window=sub.return_window)
+        return cls(
+            sub=sub,
+            midway_point=trip.midway_point,
+            departure_report=departure_report,
+            return_report=return_report,
+            best_window=best_window)
+
+    def to_archive_records(self, day: datetime.date) -> typing.List[archive.ArchiveRecord]:
+        legs = [
+            (archive.LEG_DEPARTURE, self.departure_report),
+            (archive.LEG_RETURN, self.return_report),
+        ]
+        if self.best_window is not None:
+            legs.append((archive.LEG_BEST_DEPARTURE, self.best_window.departure_report))
+            legs.append((archive.LEG_BEST_RETURN, self.best_window.return_report))
+        key = self.sub.key()
+        return [
+            report.to_archive_record(day, key, leg, self.midway_point)
+            for leg, report in legs
+        ]
+
+
+def create_fingerprint(
+        sub: Subscription,
+        forecast: typing.Sequence[Weather],
+        day: datetime.datetime) -> str:
+    """
+    Hash of everything a subscriber's report depends on: the day, the
+    subscription and the departure and return slots, or every slot when
+    the best window is searched. Equal fingerprints mean an equal report.
+    """
+    departure = Weather.get_closest(forecast, get_datetime_for_time(day, sub.departure_time))
+    return_ = Weather.get_closest(forecast, get_datetime_for_time(day, sub.return_time))
+    inputs = [
+        day.strftime('%Y-%m-%d'),
+        sub.to_serializable(),
+        departure.to_row(),
+        return_.to_row(),
+    ]
+    if sub.best_window:
+        inputs.append([weather.to_row() for weather in forecast])
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+@dataclasses.dataclass(frozen=True)
+class RenderChunk:
+    """
+    Subscriptions that share a midway point, flattened to tuples so that the
+    chunk pickles cheaply on its way to a worker process.
+    """
+    midway_point: tuple
+    forecast_rows: typing.Tuple[tuple, ...]  # Weather.to_row
+    sub_rows: typing.List[tuple]  # dataclasses.astuple(Subscription)
+    day: datetime.datetime
+    from_address: str
+    # per sub row: the fingerprint of the last evaluated inputs, or None
+    last_fingerprints: typing.Optional[typing.List[typing.Optional[str]]] = None
+    # per sub row: (departure total, return total) from the last email, or None
+    last_totals: typing.Optional[typing.List[typing.Optional[typing.Tuple[float, float]]]] = None
+    # only render if a total moved by more than this since the last email
+    min_change: typing.Optional[float] = None
+    # render template data for a templated MailTransport instead of MIME
+    templated: bool = False
+
+
+def create_render_chunks(
+        subs: typing.Iterable[Subscription],
+        forecasts: typing.Mapping[tuple, typing.Sequence[Weather]],
+        day: datetime.datetime,
+        from_address: str,
+        chunk_size: int = RENDER_CHUNK_SIZE,
+        last_totals: typing.Optional[typing.Mapping[str, typing.Tuple[float, float]]] = None,
+        min_change: typing.Optional[float] = None,
+        last_fingerprints: typing.Optional[typing.Mapping[str, str]] = None,
+        templated: bool = False) -> typing.List[RenderChunk]:
+    """
+    Groups subscriptions by midway point, so that each chunk carries a single
+    forecast. last_totals maps Subscription.key to the totals last sent, and
+    last_fingerprints to the fingerprints last evaluated.
+    """
+    last_totals = last_totals or {}
+    last_fingerprints = last_fingerprints or {}
+    subs_by_point = {}
+    for sub in subs:
+        point = get_midway_point(sub.home, sub.dest)
+        subs_by_point.setdefault(point, []).append(sub)
+
+    chunks = []
+    for point, point_subs in subs_by_point.items():
+        forecast_rows = tuple(weather.to_row() for weather in forecasts[point])
+        for i in range(0, len(point_subs), chunk_size):
+            chunk_subs = point_subs[i:i + chunk_size]
+            keys = [sub.key() for sub in chunk_subs] if last_fingerprints or last_totals else None
+            chunks.append(RenderChunk(
+                midway_point=point,
+                forecast_rows=forecast_rows,
+                sub_rows=[dataclasses.astuple(sub) for sub in chunk_subs],
+                day=day,
+                from_address=from_address,
+                last_fingerprints=[last_fingerprints.get(key) for key in keys] if last_fingerprints else None,
+                last_totals=[last_totals.get(key) for key in keys] if last_totals else None,
+                min_change=min_change,
+                templated=templated))
+    return chunks
+
+
+@dataclasses.dataclass(frozen=True)
+class RenderedMessage:
+    key: str  # see Subscription.key
+    to_address: str
+    fingerprint: str  # see create_fingerprint
+    # None when neither total moved by more than RenderChunk.min_change
+    message: typing.Optional[mail.OutgoingMessage]
+    departure_total: float
+    return_total: float
+    archive_records: typing.List[archive.ArchiveRecord]
+
+
+@dataclasses.dataclass(frozen=True)
+class RenderFailure:
+    key: str  # see Subscription.key
+    to_address: str
+    error: str
+
+
+def render_subscription(
+        chunk: RenderChunk,
+        forecast: typing.Sequence[Weather],
+        i: int) -> typing.Optional[RenderedMessage]:
+    """
+    Scores and renders chunk.sub_rows[i], or returns None when its
+    fingerprint matches chunk.last_fingerprints.
+    """
+    sub = Subscription(*chunk.sub_rows[i])
+    fingerprint = create_fingerprint(sub, forecast, chunk.day)
+    if chunk.last_fingerprints and chunk.last_fingerprints[i] == fingerprint:
+        return None
+    scored = ScoredTrip.create(
+        Trip(sub=sub, midway_point=chunk.midway_point, forecast=forecast), chunk.day)
+    totals = (scored.departure_report.total, scored.return_report.total)
+
+    message = None
+    last = chunk.last_totals[i] if chunk.last_totals else None
+    if chunk.min_change is None or last is None or any(
+            abs(total - last_total) > chunk.min_change
+            for total, last_total in zip(totals, last)):
+        if chunk.templated:
+            message = mail.OutgoingMessage(sub.email, template_data=create_template_data(
+                sub,
+                scored.departure_report,
+                scored.return_report,
+                scored.best_window))
+        else:
+            message = mail.OutgoingMessage(sub.email, mime=create_message(
+                sub,
+                scored.departure_report,
+                scored.return_report,
+                scored.best_window,
+                chunk.from_address).as_string())
+    return RenderedMessage(
+        key=sub.key(),
+        to_address=sub.email,
+        fingerprint=fingerprint,
+        message=message,
+        departure_total=totals[0],
+        return_total=totals[1],
+        archive_records=scored.to_archive_records(chunk.day))
+
+
+def render_chunk(chunk: RenderChunk) -> typing.List[typing.Union[RenderedMessage, RenderFailure]]:
+    """
+    Scores and renders every subscription in a chunk, leaving out those whose
+    fingerprint matches chunk.last_fingerprints. A subscription that fails
+    gets a RenderFailure instead of failing the chunk. Meant to run in a
+    worker process.
+    """
+    forecast = tuple(Weather.from_row(row) for row in chunk.forecast_rows)
+    messages = []
+    for i, row in enumerate(chunk.sub_rows):
+        try:
+            message = render_subscription(chunk, forecast, i)
+        except Exception as exc:
+            sub = Subscription(*row)
+            logger.exception("Failed to render the forecast for %s", sub.email)
+            message = RenderFailure(key=sub.key(), to_address=sub.email, error=repr(exc))
+        if message is not None:
+            messages.append(message)
+    return messages
+
+
+def send_notifications(
+        workers: typing.Optional[typing.Mapping[str, int]] = None,
+        transport: typing.Union[str, mail.MailTransport, None] = None):
+    """
+    Runs the batch as a pipeline: the store is read into the fetch stage,
+    then each subscription is scored, rendered and sent by its own stage.
+    workers overrides PIPELINE_WORKERS per stage. transport is a
+    MailTransport or the name of one, defaulting to MAIL_TRANSPORT.
+    A failing subscription doesn't stop the others, but the run raises at
+    the end if any failed.
+    """
+    logger.info('Sending notifications!')
+    secrets = get_secrets()
+    from_address = secrets['email_user']
+    if not isinstance(transport, mail.MailTransport):
+        transport = create_transport(transport or MAIL_TRANSPORT, secrets)
+    workers = {**PIPELINE_WORKERS, **(workers or {})}
+    day = datetime.datetime.today()
+    forecasts = ForecastCache()
+    archive_records = []
+
+    def fetch(subscription_data: dict) -> Trip:
+        sub = Subscription.from_data(subscription_data)
+        midway_point = get_midway_point(sub.home, sub.dest)
+        return Trip(
+            sub=sub,
+            midway_point=midway_point,
+            forecast=forecasts.get(midway_point))
+
+    def score(trip: Trip) -> ScoredTrip:
+        scored = ScoredTrip.create(trip, day)
+        archive_records.extend(scored.to_archive_records(day))
+        return scored
+
+    def render(scored: ScoredTrip) -> mail.OutgoingMessage:
+        if transport.templated:
+            return mail.OutgoingMessage(
+                scored.sub.email,
+                template_data=create_template_data(
+                    scored.sub,
+                    scored.departure_report,
+                    scored.return_report,
+                    scored.best_window))
+        msg = create_message(
+            scored.sub,
+            scored.departure_report,
+            scored.return_report,
+            scored.best_window,
+            from_address)
+        return mail.OutgoingMessage(scored.sub.email, mime=msg.as_string())
+
+    stages = [
+        Stage('fetch', fetch, workers['fetch'], PIPELINE_QUEUE_SIZE),
+        Stage('score', score, workers['score'], PIPELINE_QUEUE_SIZE),
+        Stage('render', render, workers['render'], PIPELINE_QUEUE_SIZE),
+        Stage('send', transport.send, workers['send'], PIPELINE_QUEUE_SIZE, batch_size=transport.batch_size),
+    ]
+    results = Pipeline(get_store(), stages).run()
+    sent = [result for result in results if result.ok]
+    logger.info('Sent %d notifications!', len(sent))
+
+    failed = sum(stage.errors for stage in stages) + len(results) - len(sent)
+    if failed:
+        logger.error('Failed to notify %d subscriptions', failed)
+
+    archive_records.extend(create_forecast_archive_records(day, forecasts.items()))
+    if archive_records:
+        try:
+            save_archive_chunk(archive_records)
+        except Exception:
+            # the emails are already out; losing history must not fail the run
+            logger.exception("Failed to archive %d records", len(archive_records))
+
+    if failed:
+        # fail the invocation, so that it shows up in the Lambda error metrics
+        raise RuntimeError(f'Failed to notify {failed} subscriptions')
 
 
 def handler(event, context):
-    send_notifications()
+    """
+    Optional event fields:
+        workers: per-stage worker counts, see PIPELINE_WORKERS
+        profile: true, false or a sample rate; see profiling.py
+        profile_destination: local directory or s3://bucket/prefix
+        mail_transport: 'smtp' or 'ses', see MAIL_TRANSPORT
+    """
+    event = event if isinstance(event, dict) else {}
+    profiler = profiling.maybe_profile(
+        name='lambda',
+        default_destination=PROFILE_DESTINATION,
+        sample_rate=event.get('profile'),
+        destination=event.get('profile_destination'))
+    with profiler:
+        send_notifications(
+            workers=event.get('workers'),
+            transport=event.get('mail_transport'))
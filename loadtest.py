@@ -0,0 +1,329 @@
+"""
+Load generator for the Tornado server.
+
+Drives a mix of GET / and POST /subscription requests at a fixed concurrency
+and reports requests/sec, latency percentiles and error rates per endpoint.
+Without --url the server is started in-process against a temporary store,
+with the weather API and SMTP stubbed out, and the notification run can be
+triggered alongside the load with --notify-interval.
+
+    python loadtest.py --requests 2000 --concurrency 1,10,50,200 --mix health=1,subscription=3
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import dataclasses
+import json
+import logging
+import multiprocessing
+import pathlib
+import random
+import sys
+import tempfile
+import time
+import typing
+from unittest import mock
+
+import tornado.httpclient
+import tornado.httpserver
+import tornado.testing
+
+import mail
+import server
+
+logger = logging.getLogger(__name__)
+ENDPOINTS = ('health', 'subscription')
+DEFAULT_MIX = {'health': 1, 'subscription': 1}
+
+
+def subscription_data(i: int) -> dict:
+    return {
+        "name": f"Rider {i}",
+        "email": f"loadtest-{i}@example.com",
+        "home": [52.37 + (i % 10) / 100, 4.89],
+        "dest": [52.09, 5.12 + (i % 10) / 100],
+        "departure_time": 800,
+        "return_time": 1730,
+    }
+
+
+def stub_weather_data(coords: tuple) -> dict:
+    """
+    Five days of mild three-hourly slots, starting now.
+    """
+    start = int(time.time()) // 10800 * 10800
+    return {
+        "list": [
+            {
+                "dt": start + i * 10800,
+                "main": {"temp_min": 14, "temp_max": 18, "humidity": 60},
+                "wind": {"speed": 12, "deg": 240},
+                "clouds": {"all": 40},
+            }
+            for i in range(40)
+        ]
+    }
+
+
+class StubSMTP:
+    """
+    Stands in for smtplib.SMTP and records every message it is asked to send.
+    """
+
+    def __init__(self, sent: list):
+        self.sent = sent
+
+    def __call__(self, host=None, port=None):
+        return self
+
+    def set_debuglevel(self, level):
+        pass
+
+    def ehlo(self):
+        pass
+
+    def starttls(self):
+        pass
+
+    def login(self, user, password):
+        pass
+
+    def sendmail(self, from_address, to_address, msg):
+        self.sent.append(to_address)
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@contextlib.contextmanager
+def stubbed_server(store_path: typing.Union[str, pathlib.Path]):
+    """
+    Points the server at store_path, with fingerprints and the archive next to it, and stubs
+    the weather API, secrets and SMTP. Yields the list of addresses the server sends email to.
+    """
+    store_path = pathlib.Path(store_path)
+    if not store_path.exists():
+        store_path.write_text('[]')
+    sent = []
+    with mock.patch.object(server, 'STORE_PATH', str(store_path)), \
+            mock.patch.object(server, 'FINGERPRINTS_PATH', str(store_path.with_name('fingerprints.json'))), \
+            mock.patch.object(server, 'ARCHIVE_PATH', str(store_path.with_name('archive'))), \
+            mock.patch.object(server, 'get_weather_data', stub_weather_data), \
+            mock.patch.object(server, 'get_secrets', lambda: {'email_user': 'loadtest@example.com', 'email_pass': ''}), \
+            mock.patch.object(mail.smtplib, 'SMTP', StubSMTP(sent)):
+        yield sent
+
+
+def start_server() -> typing.Tuple[tornado.httpserver.HTTPServer, str]:
+    """
+    Starts the app on an unused port of the current event loop.
+    """
+    sock, port = tornado.testing.bind_unused_port()
+    http_server = tornado.httpserver.HTTPServer(server.make_app())
+    http_server.add_sockets([sock])
+    return http_server, f'http://127.0.0.1:{port}'
+
+
+@dataclasses.dataclass
+class LoadReport:
+    concurrency: int
+    duration: float
+    latencies: typing.Dict[str, typing.List[float]]  # seconds, per endpoint
+    errors: typing.Dict[str, int]  # per endpoint
+    subscriptions_sent: int = 0
+    notification_runs: int = 0
+    notification_errors: int = 0
+
+    @property
+    def requests(self) -> int:
+        return sum(len(latencies) for latencies in self.latencies.values())
+
+    @property
+    def requests_per_second(self) -> float:
+        return self.requests / self.duration if self.duration else 0
+
+    @property
+    def error_rate(self) -> float:
+        return sum(self.errors.values()) / self.requests if self.requests else 0
+
+    def percentile(self, p: float, endpoint: typing.Optional[str] = None) -> float:
+        """
+        Nearest-rank percentile of the latencies, in seconds.
+        """
+        if endpoint is None:
+            latencies = [latency for values in self.latencies.values() for latency in values]
+        else:
+            latencies = self.latencies.get(endpoint, [])
+        if not latencies:
+            return 0
+        latencies = sorted(latencies)
+        rank = max(int(round(p / 100 * len(latencies))) - 1, 0)
+        return latencies[min(rank, len(latencies) - 1)]
+
+    def format(self) -> str:
+        lines = [
+            f"concurrency {self.concurrency}: {self.requests} requests in {self.duration:.2f}s, "
+            f"{self.requests_per_second:.1f} req/s, {self.error_rate:.2%} errors, "
+            f"{self.notification_runs} notification runs, {self.notification_errors} failed"
+        ]
+        for endpoint in sorted(self.latencies):
+            count = len(self.latencies[endpoint])
+            lines.append(
+                f"    {endpoint:<12} n={count:<6} errors={self.errors.get(endpoint, 0):<4} "
+                f"p50={self.percentile(50, endpoint) * 1000:.1f}ms "
+                f"p90={self.percentile(90, endpoint) * 1000:.1f}ms "
+                f"p99={self.percentile(99, endpoint) * 1000:.1f}ms "
+                f"max={self.percentile(100, endpoint) * 1000:.1f}ms")
+        return "\n".join(lines)
+
+
+async def run_load(
+        base_url: str,
+        requests: int = 1000,
+        concurrency: int = 50,
+        mix: typing.Optional[typing.Mapping[str, float]] = None,
+        notify_interval: typing.Optional[float] = None,
+        first_subscription: int = 0,
+        executor: typing.Optional[concurrent.futures.Executor] = None) -> LoadReport:
+    """
+    Sends requests drawn from mix (endpoint -> weight) with at most
+    concurrency requests in flight. With notify_interval, the server's
+    notification run is started that often while the load is running; that
+    only makes sense when the server runs in this process. executor is
+    passed on to the notification run.
+    """
+    mix = mix or DEFAULT_MIX
+    for endpoint in mix:
+        assert endpoint in ENDPOINTS, f'Unknown endpoint {endpoint}'
+    rng = random.Random(0)
+    plan = rng.choices(list(mix), weights=list(mix.values()), k=requests)
+
+    client = tornado.httpclient.AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    report = LoadReport(
+        concurrency=concurrency,
+        duration=0,
+        latencies={endpoint: [] for endpoint in mix},
+        errors={endpoint: 0 for endpoint in mix})
+    next_request = iter(enumerate(plan))
+
+    async def send(i: int, endpoint: str):
+        if endpoint == 'health':
+            request = tornado.httpclient.HTTPRequest(f'{base_url}/')
+        else:
+            request = tornado.httpclient.HTTPRequest(
+                f'{base_url}/subscription',
+                method='POST',
+                body=json.dumps(subscription_data(first_subscription + i)))
+        start = time.perf_counter()
+        try:
+            response = await client.fetch(request, raise_error=False)
+            failed = response.code >= 400 or response.error is not None
+        except Exception:
+            failed = True
+        report.latencies[endpoint].append(time.perf_counter() - start)
+        if failed:
+            report.errors[endpoint] += 1
+        elif endpoint == 'subscription':
+            report.subscriptions_sent += 1
+
+    async def worker():
+        for i, endpoint in next_request:
+            await send(i, endpoint)
+
+    async def notifier():
+        while True:
+            await asyncio.sleep(notify_interval)
+            try:
+                await server.send_notifications(executor)
+            except Exception:
+                logger.exception('Notification run failed')
+                report.notification_errors += 1
+            report.notification_runs += 1
+
+    notifications = asyncio.ensure_future(notifier()) if notify_interval is not None else None
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    finally:
+        report.duration = time.perf_counter() - start
+        if notifications is not None:
+            notifications.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await notifications
+        client.close()
+    return report
+
+
+def parse_mix(value: str) -> typing.Dict[str, float]:
+    mix = {}
+    for part in value.split(','):
+        endpoint, _, weight = part.partition('=')
+        mix[endpoint.strip()] = float(weight or 1)
+    return mix
+
+
+async def main(args):
+    levels = [int(level) for level in args.concurrency.split(',')]
+    mix = parse_mix(args.mix)
+
+    if args.url:
+        for concurrency in levels:
+            report = await run_load(args.url, args.requests, concurrency, mix)
+            print(report.format())
+        return 0
+
+    executor = None
+    if args.processes:
+        # spawn, as server.task does, so workers don't inherit the event loop
+        executor = concurrent.futures.ProcessPoolExecutor(
+            args.processes,
+            mp_context=multiprocessing.get_context('spawn'))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store_path = pathlib.Path(tmp) / 'store.json'
+        with stubbed_server(store_path):
+            http_server, base_url = start_server()
+            offset = 0
+            subscriptions_sent = 0
+            notification_errors = 0
+            for concurrency in levels:
+                report = await run_load(
+                    base_url, args.requests, concurrency, mix,
+                    notify_interval=args.notify_interval,
+                    first_subscription=offset,
+                    executor=executor)
+                offset += args.requests
+                subscriptions_sent += report.subscriptions_sent
+                notification_errors += report.notification_errors
+                print(report.format())
+            http_server.stop()
+            stored = len(json.loads(store_path.read_bytes()))
+    if executor is not None:
+        executor.shutdown()
+
+    print(f"{stored} of {subscriptions_sent} accepted subscriptions stored")
+    failed = False
+    if stored != subscriptions_sent:
+        print(f"LOST {subscriptions_sent - stored} subscriptions")
+        failed = True
+    if notification_errors:
+        print(f"{notification_errors} notification runs FAILED")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', help='Load an already running server instead of an in-process one')
+    parser.add_argument('--requests', type=int, default=1000, help='Requests per concurrency level')
+    parser.add_argument('--concurrency', default='50', help='Comma separated concurrency levels')
+    parser.add_argument('--mix', default='health=1,subscription=1', help='endpoint=weight,...')
+    parser.add_argument('--notify-interval', type=float, default=None,
+                        help='Seconds between in-process notification runs during the load')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='Render in-process notification runs on this many worker processes')
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,186 @@
+"""
+Mail transports.
+
+A transport sends a batch of OutgoingMessages and reports a SendResult per
+recipient, so one bad address never fails the rest of its batch.
+
+    SMTPTransport: one SMTP connection per batch, one transaction per message
+    SESBulkTransport: one SES SendBulkTemplatedEmail call per batch of up to
+        50 recipients, rendered by SES from a stored template
+"""
+import abc
+import boto3
+import dataclasses
+import json
+import logging
+import smtplib
+import typing
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+SES_MAX_DESTINATIONS = 50
+
+
+@dataclasses.dataclass(frozen=True)
+class OutgoingMessage:
+    to_address: str
+    mime: typing.Optional[str] = None  # for transports that send rendered messages
+    template_data: typing.Optional[typing.Mapping] = None  # for templated transports
+
+
+@dataclasses.dataclass(frozen=True)
+class SendResult:
+    to_address: str
+    ok: bool
+    error: typing.Optional[str] = None
+    message_id: typing.Optional[str] = None
+
+
+class MailTransport(abc.ABC):
+    # messages per send() call
+    batch_size = 1
+    # whether messages need template_data (True) or a rendered mime (False)
+    templated = False
+
+    @abc.abstractmethod
+    def send(self, messages: typing.Sequence[OutgoingMessage]) -> typing.List[SendResult]:
+        """
+        One SendResult per message, in order. Failures are reported in the
+        results rather than raised.
+        """
+
+
+class SMTPTransport(MailTransport):
+    def __init__(
+            self,
+            from_address: str,
+            password: str,
+            host: str = 'smtp.gmail.com',
+            port: int = 587,
+            batch_size: int = 20):
+        self.from_address = from_address
+        self.password = password
+        self.host = host
+        self.port = port
+        self.batch_size = batch_size
+
+    def connect(self) -> smtplib.SMTP:
+        smtp = smtplib.SMTP(self.host, self.port)
+        try:
+            smtp.set_debuglevel(0)
+            smtp.ehlo()
+            smtp.starttls()
+            smtp.ehlo()
+            smtp.login(self.from_address, self.password)
+        except Exception:
+            smtp.close()
+            raise
+        return smtp
+
+    def send(self, messages: typing.Sequence[OutgoingMessage]) -> typing.List[SendResult]:
+        try:
+            smtp = self.connect()
+        except (OSError, smtplib.SMTPException) as exc:
+            logger.error('Failed to connect to %s, %d emails not sent: %s', self.host, len(messages), exc)
+            return [
+                SendResult(message.to_address, ok=False, error=str(exc))
+                for message in messages
+            ]
+
+        results = []
+        try:
+            for message in messages:
+                logger.info('Sending email to %s!', message.to_address)
+                try:
+                    smtp.sendmail(self.from_address, message.to_address, message.mime)
+                except smtplib.SMTPServerDisconnected as exc:
+                    # nothing else in this batch can go out on this connection
+                    logger.error('Lost SMTP connection, %d emails not sent: %s', len(messages) - len(results), exc)
+                    for unsent in messages[len(results):]:
+                        results.append(SendResult(unsent.to_address, ok=False, error=str(exc)))
+                    return results
+                except smtplib.SMTPException as exc:
+                    logger.error('Failed to send email to %s: %s', message.to_address, exc)
+                    results.append(SendResult(message.to_address, ok=False, error=str(exc)))
+                    continue
+                logger.info('Sent email to %s!', message.to_address)
+                results.append(SendResult(message.to_address, ok=True))
+        finally:
+            try:
+                smtp.quit()
+            except smtplib.SMTPException:
+                pass
+        return results
+
+
+class SESBulkTransport(MailTransport):
+    templated = True
+
+    def __init__(
+            self,
+            from_address: str,
+            template: str,
+            default_template_data: typing.Optional[typing.Mapping] = None,
+            client=None,
+            batch_size: int = SES_MAX_DESTINATIONS):
+        assert 1 <= batch_size <= SES_MAX_DESTINATIONS, \
+            f'SES accepts up to {SES_MAX_DESTINATIONS} destinations per call'
+        self.from_address = from_address
+        self.template = template
+        self.default_template_data = default_template_data or {}
+        self.client = client or boto3.client("ses")
+        self.batch_size = batch_size
+
+    def ensure_template(self, subject: str, text: str, html: str):
+        """
+        Creates or updates the SES template that messages are rendered with.
+        """
+        template = {
+            "TemplateName": self.template,
+            "SubjectPart": subject,
+            "TextPart": text,
+            "HtmlPart": html,
+        }
+        try:
+            self.client.get_template(TemplateName=self.template)
+        except self.client.exceptions.TemplateDoesNotExistException:
+            self.client.create_template(Template=template)
+        else:
+            self.client.update_template(Template=template)
+
+    def send(self, messages: typing.Sequence[OutgoingMessage]) -> typing.List[SendResult]:
+        assert len(messages) <= self.batch_size, 'Too many messages for one call'
+        logger.info('Sending %d templated emails!', len(messages))
+        try:
+            response = self.client.send_bulk_templated_email(
+                Source=self.from_address,
+                Template=self.template,
+                DefaultTemplateData=json.dumps(self.default_template_data),
+                Destinations=[
+                    {
+                        "Destination": {"ToAddresses": [message.to_address]},
+                        "ReplacementTemplateData": json.dumps(message.template_data),
+                    }
+                    for message in messages
+                ])
+        except Exception as exc:
+            logger.error('Failed to send %d templated emails: %s', len(messages), exc)
+            return [
+                SendResult(message.to_address, ok=False, error=str(exc))
+                for message in messages
+            ]
+
+        # Status lines up with Destinations
+        results = []
+        for message, status in zip(messages, response["Status"]):
+            ok = status.get("Status", "Success") == "Success" and "MessageId" in status
+            error = None if ok else status.get("Error") or status.get("Status")
+            if not ok:
+                logger.error('Failed to send email to %s: %s', message.to_address, error)
+            results.append(SendResult(
+                message.to_address,
+                ok=ok,
+                error=error,
+                message_id=status.get("MessageId")))
+        return results
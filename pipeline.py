@@ -0,0 +1,186 @@
+"""
+Threaded stages joined by bounded queues.
+
+Each stage has its own worker count and input queue. A full queue blocks the
+stage in front of it, so a slow stage applies backpressure instead of letting
+work pile up in memory. Queue depths are logged while the pipeline runs and
+the deepest each queue got is logged at the end; the stage behind the deepest
+queue is the bottleneck.
+"""
+import logging
+import profiling
+import queue
+import threading
+import typing
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_DONE = object()
+
+
+class Stage:
+    def __init__(
+            self,
+            name: str,
+            func: typing.Callable[[typing.Any], typing.Any],
+            workers: int = 1,
+            queue_size: int = 16,
+            batch_size: typing.Optional[int] = None):
+        """
+        func is called with each item from the previous stage. Returning None
+        drops the item; an exception is logged and drops the item too.
+
+        With a batch_size, func is called with lists of up to batch_size items
+        instead and returns a list of results, each passed on by itself.
+        """
+        assert workers >= 1, f'Stage {name} needs at least one worker'
+        assert batch_size is None or batch_size >= 1, f'Stage {name} needs a positive batch size'
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.max_depth = 0
+        self.processed = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._running = workers
+
+    def put(self, item):
+        self.queue.put(item)
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def finish_worker(self) -> bool:
+        """
+        Returns True for the last worker of this stage to finish.
+        """
+        with self._lock:
+            self._running -= 1
+            return self._running == 0
+
+
+class Pipeline:
+    def __init__(
+            self,
+            source: typing.Iterable,
+            stages: typing.Sequence[Stage],
+            report_interval: typing.Optional[float] = 10):
+        assert stages, 'A pipeline needs at least one stage'
+        self.source = source
+        self.stages = stages
+        self.report_interval = report_interval
+        self.results = []
+        self._results_lock = threading.Lock()
+        self._finished = threading.Event()
+
+    def depths(self) -> typing.Mapping[str, int]:
+        return {stage.name: stage.queue.qsize() for stage in self.stages}
+
+    def stats(self) -> typing.Mapping[str, typing.Mapping[str, int]]:
+        return {
+            stage.name: {
+                "workers": stage.workers,
+                "depth": stage.queue.qsize(),
+                "max_depth": stage.max_depth,
+                "processed": stage.processed,
+                "errors": stage.errors,
+            }
+            for stage in self.stages
+        }
+
+    def run(self) -> typing.List:
+        """
+        Runs every item from the source through every stage and returns the
+        non-None results of the last stage, in completion order.
+        """
+        threads = [threading.Thread(target=self._feed, name='pipeline-source', daemon=True)]
+        for index, stage in enumerate(self.stages):
+            for i in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=self._work,
+                    args=(index,),
+                    name=f'pipeline-{stage.name}-{i}',
+                    daemon=True))
+        if self.report_interval:
+            threading.Thread(target=self._report, name='pipeline-report', daemon=True).start()
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self._finished.set()
+
+        logger.info("Pipeline finished: %s", self.stats())
+        return self.results
+
+    def _close(self, index: int):
+        if index < len(self.stages):
+            stage = self.stages[index]
+            for _ in range(stage.workers):
+                stage.queue.put(_DONE)
+
+    def _feed(self):
+        try:
+            for item in self.source:
+                self.stages[0].put(item)
+        except Exception:
+            logger.exception("Pipeline source failed")
+        finally:
+            self._close(0)
+
+    def _work(self, index: int):
+        with profiling.profile_thread():
+            self._process(index)
+
+    def _process(self, index: int):
+        stage = self.stages[index]
+        done = False
+        while not done:
+            item = stage.queue.get()
+            if item is _DONE:
+                break
+            if stage.batch_size is None:
+                self._call(index, item, [item])
+                continue
+
+            # fill the batch unless the stage is closed first
+            batch = [item]
+            while len(batch) < stage.batch_size:
+                item = stage.queue.get()
+                if item is _DONE:
+                    done = True
+                    break
+                batch.append(item)
+            self._call(index, batch, batch)
+
+        if stage.finish_worker():
+            self._close(index + 1)
+
+    def _call(self, index: int, arg, items: typing.List):
+        stage = self.stages[index]
+        try:
+            result = stage.func(arg)
+        except Exception:
+            logger.exception("Pipeline stage %s failed", stage.name)
+            with stage._lock:
+                stage.errors += len(items)
+            return
+        with stage._lock:
+            stage.processed += len(items)
+
+        results = [result] if stage.batch_size is None else result or []
+        for result in results:
+            if result is None:
+                continue
+            if index + 1 < len(self.stages):
+                self.stages[index + 1].put(result)
+            else:
+                with self._results_lock:
+                    self.results.append(result)
+
+    def _report(self):
+        while not self._finished.wait(self.report_interval):
+            logger.info("Pipeline queue depths: %s", self.depths())
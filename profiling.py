@@ -0,0 +1,240 @@
+"""
+Opt-in cProfile and tracemalloc around a notification run.
+
+A run is profiled with probability sample_rate, so profiling can stay enabled
+on a fraction of production runs. The report lists the hottest functions and
+the biggest allocation sites and is written to a local directory or to an
+s3://bucket/prefix destination.
+"""
+import boto3
+import contextlib
+import cProfile
+import datetime
+import io
+import logging
+import os
+import pathlib
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+import typing
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+SAMPLE_RATE_ENV = 'BIKERIDE_PROFILE_SAMPLE_RATE'
+DESTINATION_ENV = 'BIKERIDE_PROFILE_DESTINATION'
+TOP = 30
+
+_active = None
+_active_lock = threading.Lock()
+
+
+def get_sample_rate(value: typing.Union[bool, float, str, None] = None) -> float:
+    """
+    value is True/False, a rate between 0 and 1, either as a string, or None
+    to read the rate from the environment. Anything else turns profiling off
+    rather than failing the run.
+    """
+    if value is None:
+        value = os.environ.get(SAMPLE_RATE_ENV) or 0
+    if isinstance(value, str) and value.strip().lower() in ('true', 'false'):
+        value = value.strip().lower() == 'true'
+    if isinstance(value, bool):
+        return 1.0 if value else 0.0
+    try:
+        rate = float(value)
+    except (TypeError, ValueError):
+        logger.error("Invalid profile sample rate %r, not profiling", value)
+        return 0.0
+    if rate != rate:  # NaN
+        logger.error("Invalid profile sample rate %r, not profiling", value)
+        return 0.0
+    return min(max(rate, 0.0), 1.0)
+
+
+def should_profile(sample_rate: float) -> bool:
+    return sample_rate > 0 and random.random() < sample_rate
+
+
+def write_report(report: str, destination: str, name: str) -> str:
+    filename = f'{name}-{datetime.datetime.now().strftime("%Y%m%d-%H%M%S")}.txt'
+    if destination.startswith('s3://'):
+        bucket, _, prefix = destination[len('s3://'):].partition('/')
+        key = f'{prefix.rstrip("/")}/{filename}' if prefix else filename
+        s3 = boto3.client("s3")
+        s3.put_object(Bucket=bucket, Key=key, Body=report.encode('utf-8'))
+        return f's3://{bucket}/{key}'
+
+    path = pathlib.Path(destination)
+    path.mkdir(parents=True, exist_ok=True)
+    (path / filename).write_text(report)
+    return str(path / filename)
+
+
+class Profiler:
+    """
+    With defer_write, leaving the context only stops profiling, and the
+    caller formats and writes the report with write(), e.g. on a thread so
+    that an event loop isn't blocked by an S3 upload.
+    """
+
+    def __init__(self, name: str, destination: str, top: int = TOP, defer_write: bool = False):
+        self.name = name
+        self.destination = destination
+        self.top = top
+        self.defer_write = defer_write
+        self.report = None
+        self.location = None
+        self._stopped = None
+        self._profile = cProfile.Profile()
+        self._thread_profiles = []
+        self._lock = threading.Lock()
+        self._started_tracemalloc = False
+        self._start = None
+
+    def add(self, profile: typing.Union[cProfile.Profile, '_CollectedStats']):
+        with self._lock:
+            self._thread_profiles.append(profile)
+
+    def __enter__(self):
+        global _active
+        with _active_lock:
+            assert _active is None, 'A profiler is already running'
+            _active = self
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self._start = time.perf_counter()
+        self._profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        global _active
+        self._profile.disable()
+        elapsed = time.perf_counter() - self._start
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+        with _active_lock:
+            _active = None
+
+        self._stopped = (elapsed, peak, snapshot)
+        if not self.defer_write:
+            self.write()
+
+    def write(self):
+        self.report = self.format_report(*self._stopped)
+        try:
+            self.location = write_report(self.report, self.destination, self.name)
+            logger.info("Wrote profile to %s", self.location)
+        except Exception:
+            logger.exception("Failed to write profile to %s", self.destination)
+
+    def format_report(self, elapsed: float, peak: int, snapshot: tracemalloc.Snapshot) -> str:
+        out = io.StringIO()
+        out.write(f'Profile: {self.name}\n')
+        out.write(f'Wall time: {elapsed:.3f}s\n')
+        out.write(f'Peak traced memory: {peak / 1024:.1f} KiB\n\n')
+
+        stats = pstats.Stats(self._profile, stream=out)
+        for profile in self._thread_profiles:
+            stats.add(profile)
+        out.write('== Hot functions by cumulative time ==\n')
+        stats.sort_stats('cumulative').print_stats(self.top)
+        out.write('== Hot functions by own time ==\n')
+        stats.sort_stats('tottime').print_stats(self.top)
+
+        out.write('== Allocation sites ==\n')
+        for stat in snapshot.statistics('lineno')[:self.top]:
+            out.write(f'{stat}\n')
+        return out.getvalue()
+
+
+def maybe_profile(
+        name: str,
+        default_destination: str,
+        sample_rate: typing.Union[bool, float, str, None] = None,
+        destination: typing.Optional[str] = None,
+        defer_write: bool = False):
+    """
+    Returns a Profiler for a sampled run and a no-op context otherwise.
+    The report goes to destination, else the environment's, else the default.
+    """
+    if should_profile(get_sample_rate(sample_rate)):
+        return Profiler(
+            name,
+            destination or os.environ.get(DESTINATION_ENV) or default_destination,
+            defer_write=defer_write)
+    return contextlib.nullcontext()
+
+
+@contextlib.contextmanager
+def profile_thread():
+    """
+    Worker threads wrap their work in this so that their calls show up in the
+    running profiler's report. Does nothing when no profiler is running.
+    """
+    profiler = _active
+    if profiler is None:
+        yield
+        return
+
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Python 3.12+ allows one active profiler per process, and it
+        # already sees every thread.
+        yield
+        return
+    try:
+        yield
+    finally:
+        profile.disable()
+        profiler.add(profile)
+
+
+class _CollectedStats:
+    """
+    Raw stats from call_profiled, in the shape pstats.Stats loads.
+    """
+
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def call_profiled(func: typing.Callable, *args) -> typing.Tuple[typing.Any, typing.Optional[dict]]:
+    """
+    Runs func(*args) under its own cProfile and returns (result, stats) for
+    add_stats. Meant for work on executors, whose processes and threads the
+    running profiler doesn't see. stats is None when this process already
+    has a profiler running, which on Python 3.12+ sees every thread.
+    """
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        return func(*args), None
+    try:
+        result = func(*args)
+    finally:
+        profile.disable()
+    profile.create_stats()
+    return result, profile.stats
+
+
+def add_stats(stats: typing.Optional[dict]):
+    """
+    Merges stats from call_profiled into the running profiler's report.
+    Does nothing when no profiler is running.
+    """
+    profiler = _active
+    if profiler is not None and stats:
+        profiler.add(_CollectedStats(stats))
@@ -1,75 +1,273 @@
+import archive
 import asyncio
+import concurrent.futures
 import datetime
+import hmac
 import json
 import logging
+import mail
+import multiprocessing
+import os
 import pathlib
-import smtplib
+import profiling
+import tempfile
 import tornado.httpserver
 import tornado.ioloop
 import tornado.web
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+import typing
 
-from lib import create_email_contents, get_secrets, get_weather_data, Subscription, SuckReport
+from get_and_send_forecasts import (
+    MAIL_TRANSPORT as DEFAULT_MAIL_TRANSPORT,
+    create_transport,
+    create_forecast_archive_records,
+    create_render_chunks,
+    get_midway_point,
+    get_secrets,
+    get_weather_data,
+    render_chunk,
+    RenderChunk,
+    RenderedMessage,
+    RenderFailure,
+    Subscription,
+    Weather)
 
 logger = logging.getLogger(__name__)
 PORT = 8888
+STORE_PATH = 'store.json'
+FINGERPRINTS_PATH = 'fingerprints.json'
+ARCHIVE_PATH = 'archive'
+PROFILE_DESTINATION = 'profiles'
+# POST /profile needs this in its X-Profile-Token header; unset disables the endpoint
+PROFILE_TOKEN = os.environ.get('BIKERIDE_PROFILE_TOKEN')
+# worker processes for scoring and rendering; 0 renders on a thread instead
+NOTIFICATION_PROCESSES = int(os.environ.get('BIKERIDE_NOTIFICATION_PROCESSES', 0))
+# 'smtp' or 'ses', see get_and_send_forecasts.create_transport
+MAIL_TRANSPORT = os.environ.get('BIKERIDE_MAIL_TRANSPORT') or DEFAULT_MAIL_TRANSPORT
+# only re-notify if a total moved by more than this many points; unset sends on any change
+NOTIFY_MIN_CHANGE = float(os.environ['BIKERIDE_NOTIFY_MIN_CHANGE']) if os.environ.get('BIKERIDE_NOTIFY_MIN_CHANGE') else None
 
+# set by POST /profile, consumed by the next notification run
+profile_next_run = False
 
-def send_email(
-        sub: Subscription,
-        departure_report: SuckReport,
-        return_report: SuckReport):
-    logger.info('Sending email to %s!', sub.email)
-    secrets = get_secrets()
-    text, html = create_email_contents(sub, departure_report, return_report)
 
-    from_address = secrets['email_user']
-    msg = MIMEMultipart('alternative')
-    msg['Subject'] = "BikeRideForecast: Your Daily Report"
-    msg['From'] = from_address
-    msg['To'] = sub.email
-    msg.attach(MIMEText(text, 'plain'))
-    msg.attach( MIMEText(html, 'html'))
+def load_fingerprints() -> dict:
+    """
+    Per Subscription.key: the fingerprint of the last evaluated inputs, and
+    the day and totals of the last email sent.
+    """
+    path = pathlib.Path(FINGERPRINTS_PATH)
+    if not path.exists():
+        return {}
+    return json.loads(path.read_bytes())
 
-    smtp = smtplib.SMTP('smtp.gmail.com', 587)
-    smtp.set_debuglevel(0)
-    smtp.ehlo()
-    smtp.starttls()
-    smtp.ehlo()
-    smtp.login(from_address, secrets["email_pass"])
-    smtp.sendmail(from_address, sub.email, msg.as_string())
-    smtp.quit()
-    logger.info('Sent email to %s!', sub.email)
 
+def write_atomically(path: typing.Union[str, pathlib.Path], data: bytes):
+    """
+    Replaces path with data in one step, so that a reader on another thread
+    sees either the old or the new file, never a truncated one.
+    """
+    path = pathlib.Path(path)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
 
 
-async def send_notifications():
+def save_fingerprints(fingerprints: dict):
+    write_atomically(FINGERPRINTS_PATH, bytes(json.dumps(fingerprints), 'utf-8'))
+
+
+def save_archive(
+        day: datetime.date,
+        forecasts: typing.Mapping[tuple, typing.Sequence[Weather]],
+        score_records: typing.List[archive.ArchiveRecord]):
+    """
+    Appends the scores to ARCHIVE_PATH, along with the forecast slots of
+    every midway point that has none archived for the day yet.
+    """
+    store = archive.Archive(ARCHIVE_PATH)
+    archived = {
+        (record.lat, record.lon)
+        for record in store.query(start=day, end=day, legs=[archive.LEG_FORECAST])
+    }
+    records = create_forecast_archive_records(day, [
+        (point, forecast) for point, forecast in forecasts.items()
+        if point not in archived
+    ])
+    store.append(records + score_records)
+    logger.info("Archived %d records", len(records) + len(score_records))
+
+
+def load_subscriptions() -> typing.Tuple[typing.List[Subscription], typing.List[tuple]]:
+    """
+    The stored subscriptions and their distinct midway points. Invalid ones
+    are logged and skipped.
+    """
+    subs = []
+    for data in json.loads(pathlib.Path(STORE_PATH).read_bytes()):
+        try:
+            subs.append(Subscription.from_data(data))
+        except Exception:
+            logger.exception('Skipping invalid subscription %r', data)
+    points = list({get_midway_point(sub.home, sub.dest) for sub in subs})
+    return subs, points
+
+
+def fetch_forecast(point: tuple) -> typing.Tuple[Weather, ...]:
+    return Weather.list_from_weather_data(get_weather_data(point))
+
+
+def plan_chunks(
+        subs: typing.List[Subscription],
+        forecasts: typing.Mapping[tuple, typing.Sequence[Weather]],
+        day: datetime.datetime,
+        from_address: str,
+        previous: dict,
+        min_change: typing.Optional[float],
+        templated: bool = False) -> typing.Tuple[typing.List[RenderChunk], dict]:
+    """
+    The render chunks for the subscriptions whose forecast was fetched, and
+    the previous fingerprint entries of the subscriptions that still exist.
+    """
+    today = day.strftime('%Y-%m-%d')
+    chunks = create_render_chunks(
+        [sub for sub in subs if get_midway_point(sub.home, sub.dest) in forecasts],
+        forecasts,
+        day,
+        from_address,
+        last_totals={
+            key: (entry['departure_total'], entry['return_total'])
+            for key, entry in previous.items()
+            if entry['day'] == today
+        },
+        min_change=min_change,
+        last_fingerprints={key: entry['fingerprint'] for key, entry in previous.items()},
+        templated=templated)
+    keys = {sub.key() for sub in subs}
+    kept = {key: entry for key, entry in previous.items() if key in keys}
+    return chunks, kept
+
+
+async def send_notifications(
+        executor: typing.Optional[concurrent.futures.Executor] = None,
+        min_change: typing.Optional[float] = None,
+        profile: bool = False):
+    """
+    Fetches each forecast once, then fingerprints, scores and renders the
+    subscriptions in chunks on executor (the default thread pool if None)
+    and sends the finished messages. Everything but the bookkeeping runs off
+    the event loop, so it stays free to serve requests.
+
+    Subscriptions whose fingerprint matches the last run are skipped
+    entirely. With min_change (default NOTIFY_MIN_CHANGE), changed ones are
+    only sent if a total moved by more than that since today's last email.
+    With profile, the chunks are profiled where they run and merged into
+    the running profiler.
+    """
     logger.info('Sending notifications!')
-    store = pathlib.Path('store.json')
-    subscriptions = json.loads(store.read_bytes())
-    for subscription_data in subscriptions:
-        sub = Subscription.from_data(subscription_data)
-        home = tuple(sub.home)
-        dest = tuple(sub.dest)
-        midway_point = (
-            round((home[0] + dest[0]) / 2, 6),
-            round((home[1] + dest[1]) / 2, 6)
-        )
-        weather_data = await get_weather_data(midway_point)
-        departure_report = SuckReport.create_for_trip(
-            weather_data=weather_data,
-            day=datetime.datetime.today(),
-            time=sub.departure_time,
-            pointA=home,
-            pointB=dest)
-        return_report = SuckReport.create_for_trip(
-            weather_data=weather_data,
-            day=datetime.datetime.today(),
-            time=sub.return_time,
-            pointA=dest,
-            pointB=home)
-        send_email(sub, departure_report, return_report)
+    if min_change is None:
+        min_change = NOTIFY_MIN_CHANGE
+    loop = asyncio.get_event_loop()
+    subs, points = await loop.run_in_executor(None, load_subscriptions)
+    secrets = await loop.run_in_executor(None, get_secrets)
+    forecasts = {}
+    fetched = await asyncio.gather(*[
+        loop.run_in_executor(None, fetch_forecast, point)
+        for point in points
+    ], return_exceptions=True)
+    for point, forecast in zip(points, fetched):
+        if isinstance(forecast, Exception):
+            # only the subscriptions at this point are skipped, until the next run
+            logger.error('Failed to fetch the forecast for %s: %r', point, forecast)
+        else:
+            forecasts[point] = forecast
+
+    day = datetime.datetime.today()
+    today = day.strftime('%Y-%m-%d')
+    previous = await loop.run_in_executor(None, load_fingerprints)
+    transport = await loop.run_in_executor(None, create_transport, MAIL_TRANSPORT, secrets)
+    # unchanged subscriptions keep their entry; removed ones are dropped
+    chunks, fingerprints = await loop.run_in_executor(
+        None, plan_chunks, subs, forecasts, day, secrets['email_user'], previous, min_change,
+        transport.templated)
+
+    async def render(chunk: RenderChunk) -> typing.List[typing.Union[RenderedMessage, RenderFailure]]:
+        if not profile:
+            return await loop.run_in_executor(executor, render_chunk, chunk)
+        messages, stats = await loop.run_in_executor(
+            executor, profiling.call_profiled, render_chunk, chunk)
+        profiling.add_stats(stats)
+        return messages
+
+    rendered = []
+    render_failures = []
+    for chunk, messages in zip(chunks, await asyncio.gather(
+            *[render(chunk) for chunk in chunks], return_exceptions=True)):
+        if isinstance(messages, Exception):
+            logger.error('Failed to render %d subscriptions at %s: %r',
+                         len(chunk.sub_rows), chunk.midway_point, messages)
+            continue
+        for message in messages:
+            if isinstance(message, RenderFailure):
+                render_failures.append(message.to_address)
+            else:
+                rendered.append(message)
+    logger.info('%d of %d subscriptions changed', len(rendered), len(subs))
+    if render_failures:
+        logger.error('Failed to render %s', render_failures)
+
+    messages = []
+    sent_entries = []
+    score_records = []
+    for item in rendered:
+        score_records.extend(item.archive_records)
+        if item.message is None:
+            # too small a change to send; keep the totals of the last email
+            fingerprints[item.key] = {**previous[item.key], 'fingerprint': item.fingerprint}
+            continue
+        messages.append(item.message)
+        sent_entries.append((item.key, {
+            'fingerprint': item.fingerprint,
+            'day': today,
+            'departure_total': item.departure_total,
+            'return_total': item.return_total,
+        }))
+
+    results = []
+    for i in range(0, len(messages), transport.batch_size):
+        batch = messages[i:i + transport.batch_size]
+        try:
+            results.extend(await loop.run_in_executor(None, transport.send, batch))
+        except Exception as exc:
+            # record the batch as failed, so the batches already sent aren't sent again
+            logger.exception('Failed to send %d emails', len(batch))
+            results.extend(mail.SendResult(message.to_address, ok=False, error=str(exc)) for message in batch)
+
+    failed = []
+    # transports return one result per message, in order
+    for (key, entry), result in zip(sent_entries, results):
+        if result.ok:
+            fingerprints[key] = entry
+        else:
+            failed.append(result.to_address)
+            # keep the old fingerprint, so the next run tries again
+            if key in previous:
+                fingerprints[key] = previous[key]
+    await loop.run_in_executor(None, save_fingerprints, fingerprints)
+
+    logger.info('Sent %d notifications!', len(results) - len(failed))
+    if failed:
+        logger.error('Failed to notify %s', failed)
+
+    try:
+        await loop.run_in_executor(None, save_archive, day, forecasts, score_records)
+    except Exception:
+        # the emails are already out; losing history must not fail the run
+        logger.exception("Failed to archive %d scores", len(score_records))
 
 class MainHandler(tornado.web.RequestHandler):
     def get(self):
@@ -80,38 +278,75 @@ class SubscriptionHandler(tornado.web.RequestHandler):
         logger.info('New subscription received!')
         data = json.loads(self.request.body.decode('utf-8'))
         sub = Subscription.from_data(data)
-        store = pathlib.Path('store.json')
+        store = pathlib.Path(STORE_PATH)
 
         subs = json.loads(store.read_bytes())
         subs.append(sub.to_serializable())
-        store.write_bytes(bytes(json.dumps(subs), 'utf-8'))
+        write_atomically(store, bytes(json.dumps(subs), 'utf-8'))
 
         # store email, start/end points, travel times
         logger.info("Added subscription for %s <%s>", sub.name, sub.email)
         self.write(f"Added subscription for {sub.name} at {sub.email}!")
 
 
-async def notification_worker():
+class ProfileHandler(tornado.web.RequestHandler):
+    def post(self):
+        global profile_next_run
+        token = self.request.headers.get('X-Profile-Token', '')
+        if not PROFILE_TOKEN or not hmac.compare_digest(token, PROFILE_TOKEN):
+            raise tornado.web.HTTPError(403)
+        profile_next_run = True
+        logger.info('Profiling the next notification run!')
+        self.write("The next notification run will be profiled")
+
+
+async def notification_worker(executor: typing.Optional[concurrent.futures.Executor] = None):
+    global profile_next_run
     logger.info('Starting notification worker!')
     while True:
         now = datetime.datetime.now()
         if now.hour != 6:
             print(f"Sending notifications at {datetime.datetime.now()}!")
-            await send_notifications()
+            # None falls back to BIKERIDE_PROFILE_SAMPLE_RATE. The profile
+            # covers the whole event loop, so requests served meanwhile show up too.
+            sample_rate = True if profile_next_run else None
+            profile_next_run = False
+            try:
+                profiler = profiling.maybe_profile(
+                    'server', PROFILE_DESTINATION, sample_rate=sample_rate, defer_write=True)
+                with profiler:
+                    await send_notifications(executor, profile=isinstance(profiler, profiling.Profiler))
+                if isinstance(profiler, profiling.Profiler):
+                    await asyncio.get_event_loop().run_in_executor(None, profiler.write)
+            except Exception:
+                # try again next hour rather than stopping notifications for good
+                logger.exception('Notification run failed')
         await asyncio.sleep(3600) # one hour
 
-def task():
-    app = tornado.web.Application([
+def make_app() -> tornado.web.Application:
+    return tornado.web.Application([
         (r"/", MainHandler),
-        (r"/subscription", SubscriptionHandler)
+        (r"/subscription", SubscriptionHandler),
+        (r"/profile", ProfileHandler)
     ])
 
+def task():
+    app = make_app()
+
     logger.info("Starting server on port %d!", PORT)
     server = tornado.httpserver.HTTPServer(app)
     server.listen(PORT)
 
+    executor = None
+    if NOTIFICATION_PROCESSES:
+        logger.info("Rendering notifications on %d processes!", NOTIFICATION_PROCESSES)
+        # spawn, so workers don't inherit the listening socket or the event loop
+        executor = concurrent.futures.ProcessPoolExecutor(
+            NOTIFICATION_PROCESSES,
+            mp_context=multiprocessing.get_context('spawn'))
+
     event_loop = asyncio.events.get_event_loop()
-    event_loop.create_task(notification_worker())
+    event_loop.create_task(notification_worker(executor))
     tornado.ioloop.IOLoop.current().start()
 
 if __name__ == "__main__":
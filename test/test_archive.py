@@ -0,0 +1,83 @@
+import json
+import pytest
+from datetime import date
+from archive import (
+    Archive,
+    LEG_DEPARTURE,
+    LEG_RETURN,
+    RECORD,
+    subscriber_id)
+from get_and_send_forecasts import ScoredTrip, Subscription, SuckReport, Trip, Weather
+
+
+@pytest.fixture
+def forecast():
+    with open('test/data/weather.json', 'rb') as f:
+        data = json.loads(f.read())
+    return Weather.list_from_weather_data(data)
+
+
+@pytest.fixture
+def archive(tmp_path, forecast):
+    archive = Archive(tmp_path)
+    records = []
+    for i, weather in enumerate(forecast):
+        day = date(2019, 2, 15 + i % 3)
+        report = SuckReport.create(weather, 90)
+        records.append(report.to_archive_record(day, 'route-a', LEG_DEPARTURE, (52.0, 5.0)))
+        records.append(report.to_archive_record(day, 'route-b', LEG_RETURN, (48.8, 2.3)))
+    archive.append(records)
+    return archive
+
+
+class TestArchive:
+    def test_query_all(cls, archive, forecast):
+        assert len(list(archive.query())) == len(forecast) * 2
+
+    def test_query_dates(cls, archive):
+        records = list(archive.query(start=date(2019, 2, 16), end=date(2019, 2, 16)))
+        assert records
+        assert all(record.day == 20190216 for record in records)
+        assert len(archive.get_chunks(start=20190216)) == 2
+
+    def test_query_subscribers_and_cells(cls, archive, forecast):
+        records = list(archive.query(subscribers=[subscriber_id('route-b')]))
+        assert len(records) == len(forecast)
+        assert all(record.leg == LEG_RETURN for record in records)
+
+        records = list(archive.query(lat_range=(51, 53), lon_range=(4, 6)))
+        assert len(records) == len(forecast)
+        assert all(record.leg == LEG_DEPARTURE for record in records)
+
+        assert list(archive.query(lat_range=(0, 1))) == []
+
+    def test_ignores_partial_record(cls, archive, tmp_path):
+        chunk = tmp_path / '20190215.bin'
+        count = chunk.stat().st_size // RECORD.size
+        with open(chunk, 'ab') as f:
+            f.write(b'\0' * (RECORD.size - 1))
+        assert len(list(archive.query(start=date(2019, 2, 15), end=date(2019, 2, 15)))) == count
+
+    def test_rescore(cls, archive):
+        for record in archive.query(legs=[LEG_DEPARTURE]):
+            weather = Weather.from_archive_record(record)
+            report = SuckReport.create(weather, record.travel_direction)
+            assert report.temp == pytest.approx(record.score_temp, abs=0.02)
+            assert report.wind == pytest.approx(record.score_wind, abs=0.02)
+            assert report.rain == pytest.approx(record.score_rain, abs=0.02)
+
+    def test_routes_sharing_an_email(cls, forecast):
+        data = {
+            'name': 'Dan',
+            'email': 'dan@example.com',
+            'home': [52.0, 5.0],
+            'dest': [52.1, 5.1],
+            'departure_time': 900,
+            'return_time': 1700,
+        }
+        day = date(2019, 2, 16)
+        ids = set()
+        for sub in (Subscription.from_data(data), Subscription.from_data({**data, 'dest': [52.2, 4.9]})):
+            scored = ScoredTrip.create(Trip(sub=sub, midway_point=(52.05, 5.05), forecast=forecast), day)
+            ids |= {record.subscriber for record in scored.to_archive_records(day)}
+        assert len(ids) == 2
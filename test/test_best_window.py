@@ -0,0 +1,125 @@
+import json
+import pytest
+from datetime import date, datetime, timedelta
+from get_and_send_forecasts import (
+    BestWindow,
+    Subscription,
+    SuckReport,
+    Temp,
+    Weather,
+    Wind,
+    calc_degrees_north_from_coords,
+    create_email_contents)
+
+
+@pytest.fixture
+def weather_data():
+    with open('test/data/weather.json', 'rb') as f:
+        data = json.loads(f.read())
+    return data
+
+
+@pytest.fixture
+def forecast(weather_data):
+    return Weather.list_from_weather_data(weather_data)
+
+
+class TestBestWindow:
+    def test_list_from_weather_data(cls, weather_data, forecast):
+        assert len(forecast) == len(weather_data['list'])
+        assert forecast[0] == Weather.create_from_weather_data(weather_data['list'][0])
+
+    def test_get_total_score_matches_report(cls, forecast):
+        for weather in forecast:
+            for direction in (0, 90, 180, 270):
+                assert SuckReport.get_total_score(weather, direction) == \
+                    SuckReport.create(weather, direction).total
+
+    def test_find_whole_horizon(cls, forecast):
+        pointA, pointB = (90, 90), (91, 90)
+        outbound = calc_degrees_north_from_coords(pointA, pointB)
+        inbound = calc_degrees_north_from_coords(pointB, pointA)
+        expected = min(
+            SuckReport.get_total_score(d, outbound) + SuckReport.get_total_score(r, inbound)
+            for d in forecast
+            for r in forecast
+            if r.dt > d.dt and date.fromtimestamp(r.dt) == date.fromtimestamp(d.dt))
+
+        best = BestWindow.find(forecast, datetime.fromtimestamp(1550264400), pointA, pointB)
+        assert best.return_report.weather.dt > best.departure_report.weather.dt
+        assert best.return_time.date() == best.departure_time.date()
+        assert best.departure_report.travel_direction == outbound
+        assert best.return_report.travel_direction == inbound
+        assert best.total == pytest.approx(expected)
+
+    def test_find_rejects_return_on_later_day(cls):
+        def slot(time, temp, rain=0):
+            return Weather(
+                clouds=0,
+                dt=int(time.timestamp()),
+                humidity=0,
+                rain=rain,
+                temp=Temp(min=temp, max=temp),
+                wind=Wind(speed=0, deg=0))
+
+        day = datetime(2019, 2, 15)
+        forecast = [
+            slot(day + timedelta(hours=9), 20),
+            slot(day + timedelta(hours=18), 0, rain=5),
+            # much better, but a day too late to ride home
+            slot(day + timedelta(days=1, hours=9), 20),
+        ]
+        best = BestWindow.find(forecast, day, (90, 90), (91, 90))
+        assert best.departure_time == day + timedelta(hours=9)
+        assert best.return_time == day + timedelta(hours=18)
+
+        assert BestWindow.find(forecast[:1] + forecast[2:], day, (90, 90), (91, 90)) is None
+
+    def test_find_within_windows(cls, forecast):
+        day = datetime.fromtimestamp(1550588400)
+        best = BestWindow.find(
+            forecast, day, (90, 90), (91, 90),
+            departure_window=(700, 1000),
+            return_window=(1600, 1900))
+        assert best.departure_time.date() == day.date()
+        assert best.return_time.date() == day.date()
+        assert 530 <= best.departure_time.hour * 100 + best.departure_time.minute <= 1130
+        assert 1430 <= best.return_time.hour * 100 + best.return_time.minute <= 2030
+
+    def test_find_without_matching_slots(cls, forecast):
+        day = datetime.fromtimestamp(1550588400)
+        assert BestWindow.find(
+            forecast, day, (90, 90), (91, 90),
+            departure_window=(1600, 1900),
+            return_window=(700, 1000)) is None
+
+    def test_subscription_rejects_invalid_windows(cls):
+        data = {
+            'name': 'Dan',
+            'email': 'dan@example.com',
+            'home': [90, 90],
+            'dest': [91, 90],
+            'departure_time': 900,
+            'return_time': 1700,
+            'best_window': True,
+        }
+        sub = Subscription.from_data({**data, 'departure_window': [700, 930], 'return_window': [0, 2359]})
+        assert sub.departure_window == [700, 930]
+        for window in (['7am', '9am'], [700, 2500], [760, 900], [900, 700], [700], [True, 900], [7.5, 900]):
+            with pytest.raises(AssertionError):
+                Subscription.from_data({**data, 'departure_window': window})
+
+    def test_email_contents_include_best_window(cls, forecast):
+        sub = Subscription.from_data({
+            'name': 'Dan',
+            'email': 'dan@example.com',
+            'home': [90, 90],
+            'dest': [91, 90],
+            'departure_time': 900,
+            'return_time': 1700,
+            'best_window': True})
+        best = BestWindow.find(forecast, datetime.fromtimestamp(1550264400), (90, 90), (91, 90))
+        text, html = create_email_contents(
+            sub, best.departure_report, best.return_report, best)
+        assert 'Best window' in text
+        assert f'Best window: {best.total} points' in html
@@ -0,0 +1,237 @@
+import boto3
+import json
+import pytest
+import smtplib
+from datetime import datetime
+import get_and_send_forecasts
+import mail
+from get_and_send_forecasts import (
+    BestWindow,
+    EMAIL_SUBJECT,
+    EMAIL_TEMPLATE_HTML,
+    EMAIL_TEMPLATE_TEXT,
+    SES_TEMPLATE_NAME,
+    Subscription,
+    SuckReport,
+    Weather,
+    create_template_data)
+
+moto = pytest.importorskip('moto')
+
+FROM_ADDRESS = 'forecast@example.com'
+
+
+@pytest.fixture
+def weather_data():
+    with open('test/data/weather.json', 'rb') as f:
+        data = json.loads(f.read())
+    return data
+
+
+@pytest.fixture
+def ses(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_aws():
+        client = boto3.client('ses')
+        client.verify_email_identity(EmailAddress=FROM_ADDRESS)
+        yield client
+
+
+def messages(count):
+    return [
+        mail.OutgoingMessage(f'rider{i}@example.com', mime='hi', template_data={'i': i})
+        for i in range(count)
+    ]
+
+
+class FakeSMTP:
+    def __init__(self, refused=(), disconnect_at=None, fail_login=False):
+        self.refused = refused
+        self.disconnect_at = disconnect_at
+        self.fail_login = fail_login
+        self.sent = []
+        self.connections = 0
+        self.closed = False
+
+    def __call__(self, host, port):
+        self.connections += 1
+        return self
+
+    def set_debuglevel(self, level):
+        pass
+
+    def ehlo(self):
+        pass
+
+    def starttls(self):
+        pass
+
+    def login(self, user, password):
+        if self.fail_login:
+            raise smtplib.SMTPAuthenticationError(535, b'bad credentials')
+
+    def sendmail(self, from_address, to_address, msg):
+        if to_address == self.disconnect_at:
+            raise smtplib.SMTPServerDisconnected('gone')
+        if to_address in self.refused:
+            raise smtplib.SMTPRecipientsRefused({to_address: (550, b'nope')})
+        self.sent.append(to_address)
+
+    def quit(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class TestMailTransport:
+    def test_send_is_abstract(cls):
+        class Incomplete(mail.MailTransport):
+            pass
+
+        with pytest.raises(TypeError):
+            Incomplete()
+
+
+class TestSMTPTransport:
+    def test_one_connection_per_batch(cls, monkeypatch):
+        smtp = FakeSMTP(refused=['rider1@example.com'])
+        monkeypatch.setattr(mail.smtplib, 'SMTP', smtp)
+        results = mail.SMTPTransport(FROM_ADDRESS, 'secret').send(messages(4))
+        assert smtp.connections == 1
+        assert [result.ok for result in results] == [True, False, True, True]
+        assert smtp.sent == ['rider0@example.com', 'rider2@example.com', 'rider3@example.com']
+
+    def test_disconnect_fails_rest_of_batch(cls, monkeypatch):
+        monkeypatch.setattr(mail.smtplib, 'SMTP', FakeSMTP(disconnect_at='rider2@example.com'))
+        results = mail.SMTPTransport(FROM_ADDRESS, 'secret').send(messages(4))
+        assert [result.ok for result in results] == [True, True, False, False]
+        assert [result.to_address for result in results] == [m.to_address for m in messages(4)]
+
+    def test_login_failure_fails_batch(cls, monkeypatch):
+        smtp = FakeSMTP(fail_login=True)
+        monkeypatch.setattr(mail.smtplib, 'SMTP', smtp)
+        results = mail.SMTPTransport(FROM_ADDRESS, 'secret').send(messages(3))
+        assert [result.to_address for result in results] == [m.to_address for m in messages(3)]
+        assert not any(result.ok for result in results)
+        assert all('bad credentials' in result.error for result in results)
+        assert smtp.closed
+        assert smtp.sent == []
+
+    def test_connect_failure_fails_batch(cls, monkeypatch):
+        def refuse(host, port):
+            raise ConnectionRefusedError('refused')
+
+        monkeypatch.setattr(mail.smtplib, 'SMTP', refuse)
+        results = mail.SMTPTransport(FROM_ADDRESS, 'secret').send(messages(2))
+        assert [(result.ok, result.error) for result in results] == [(False, 'refused')] * 2
+
+
+class TestSESBulkTransport:
+    def test_ensure_template(cls, ses):
+        transport = mail.SESBulkTransport(FROM_ADDRESS, SES_TEMPLATE_NAME, client=ses)
+        transport.ensure_template(EMAIL_SUBJECT, EMAIL_TEMPLATE_TEXT, EMAIL_TEMPLATE_HTML)
+        transport.ensure_template('New subject', EMAIL_TEMPLATE_TEXT, EMAIL_TEMPLATE_HTML)
+        template = ses.get_template(TemplateName=SES_TEMPLATE_NAME)['Template']
+        assert template['SubjectPart'] == 'New subject'
+
+    def test_send(cls, ses):
+        transport = mail.SESBulkTransport(FROM_ADDRESS, SES_TEMPLATE_NAME, client=ses)
+        transport.ensure_template(EMAIL_SUBJECT, EMAIL_TEMPLATE_TEXT, EMAIL_TEMPLATE_HTML)
+        results = transport.send(messages(50))
+        assert all(result.ok and result.message_id for result in results)
+        assert ses.get_send_quota()['SentLast24Hours'] == 50
+
+    def test_send_failure_reported_per_recipient(cls, ses):
+        transport = mail.SESBulkTransport('unverified@example.com', SES_TEMPLATE_NAME, client=ses)
+        transport.ensure_template(EMAIL_SUBJECT, EMAIL_TEMPLATE_TEXT, EMAIL_TEMPLATE_HTML)
+        results = transport.send(messages(3))
+        assert [result.to_address for result in results] == [m.to_address for m in messages(3)]
+        assert not any(result.ok for result in results)
+        assert all(result.error for result in results)
+
+    def test_mixed_statuses(cls):
+        class Client:
+            def send_bulk_templated_email(self, **kwargs):
+                return {'Status': [
+                    {'Status': 'Success', 'MessageId': 'a'},
+                    {'Status': 'MailFromDomainNotVerified', 'Error': 'not verified'},
+                    {'Status': 'Success', 'MessageId': 'c'},
+                ]}
+
+        transport = mail.SESBulkTransport(FROM_ADDRESS, SES_TEMPLATE_NAME, client=Client())
+        results = transport.send(messages(3))
+        assert [result.ok for result in results] == [True, False, True]
+        assert results[1].error == 'not verified'
+
+    def test_template_data(cls, weather_data):
+        sub = Subscription.from_data({
+            'name': 'Dan',
+            'email': 'dan@example.com',
+            'home': [90, 90],
+            'dest': [91, 90],
+            'departure_time': 900,
+            'return_time': 1700})
+        forecast = Weather.list_from_weather_data(weather_data)
+        departure = SuckReport.create(forecast[0], 0)
+        best = BestWindow.find(forecast, datetime.fromtimestamp(1550264400), (90, 90), (91, 90))
+        data = create_template_data(sub, departure, departure, best)
+        assert data['sub']['name'] == 'Dan'
+        assert data['departure_report']['total'] == str(departure.total)
+        assert data['departure_report']['weather']['wind']['speed'] == str(forecast[0].wind.speed)
+        assert data['best_window']['total'] == str(best.total)
+        json.dumps(data)
+
+    def test_render_template(cls):
+        template = '{{a.b}} {{missing}}{{#if c}}[{{c.d}}]{{/if}}{{#if e}}never{{/if}}'
+        data = {'a': {'b': '7.0'}, 'c': {'d': '<Tom & "Jerry">'}}
+        assert get_and_send_forecasts.render_template(template, data) == '7.0 [<Tom & "Jerry">]'
+        assert get_and_send_forecasts.render_template(template, data, escape=True) == \
+            '7.0 [&lt;Tom &amp; &quot;Jerry&quot;&gt;]'
+
+    def test_email_contents_match_templates(cls, weather_data):
+        sub = Subscription.from_data({
+            'name': 'Dan <dan>',
+            'email': 'dan@example.com',
+            'home': [90, 90],
+            'dest': [91, 90],
+            'departure_time': 900,
+            'return_time': 1700})
+        forecast = Weather.list_from_weather_data(weather_data)
+        departure = SuckReport.create(forecast[0], 90)
+        text, html = get_and_send_forecasts.create_email_contents(sub, departure, departure)
+        assert f'Total suckiness for departure at 900: {departure.total}' in text
+        assert f'Wind: {departure.wind}' in text
+        assert 'Best window' not in text
+        assert '<h1>Hey Dan &lt;dan&gt;!</h1>' in html
+        assert '{{' not in text + html
+
+    def test_send_notifications_batches_calls(cls, ses, monkeypatch, weather_data):
+        store = [
+            {
+                'name': f'Rider {i}',
+                'email': f'rider{i}@example.com',
+                'home': [52.0, 5.0],
+                'dest': [52.1, 5.1],
+                'departure_time': 900,
+                'return_time': 1700,
+            }
+            for i in range(120)
+        ]
+        calls = []
+        monkeypatch.setattr(get_and_send_forecasts, 'get_store', lambda: store)
+        monkeypatch.setattr(get_and_send_forecasts, 'get_secrets', lambda: {
+            'email_user': FROM_ADDRESS, 'email_pass': 'secret'})
+        monkeypatch.setattr(get_and_send_forecasts, 'get_weather_data', lambda point: weather_data)
+        monkeypatch.setattr(get_and_send_forecasts, 'save_archive_chunk', lambda records: None)
+
+        transport = get_and_send_forecasts.create_transport('ses', {'email_user': FROM_ADDRESS})
+        send = transport.send
+        monkeypatch.setattr(transport, 'send', lambda batch: calls.append(len(batch)) or send(batch))
+        get_and_send_forecasts.send_notifications(transport=transport)
+
+        assert sum(calls) == 120
+        assert len(calls) <= 6
+        assert ses.get_send_quota()['SentLast24Hours'] == 120
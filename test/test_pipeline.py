@@ -0,0 +1,136 @@
+import archive
+import json
+import pytest
+import threading
+import time
+import get_and_send_forecasts
+from mail import MailTransport, SendResult
+from pipeline import Pipeline, Stage
+
+
+@pytest.fixture
+def weather_data():
+    with open('test/data/weather.json', 'rb') as f:
+        data = json.loads(f.read())
+    return data
+
+
+class TestPipeline:
+    def test_runs_every_stage(cls):
+        stages = [
+            Stage('double', lambda x: x * 2, workers=3),
+            Stage('inc', lambda x: x + 1, workers=2),
+        ]
+        results = Pipeline(range(100), stages, report_interval=None).run()
+        assert sorted(results) == [x * 2 + 1 for x in range(100)]
+        assert stages[0].processed == 100
+        assert stages[1].processed == 100
+
+    def test_drops_none_and_errors(cls):
+        def check(x):
+            if x == 3:
+                raise ValueError(x)
+            return x if x % 2 else None
+
+        stages = [Stage('check', check), Stage('noop', lambda x: x)]
+        results = Pipeline(range(10), stages, report_interval=None).run()
+        assert sorted(results) == [1, 5, 7, 9]
+        assert stages[0].errors == 1
+        assert stages[1].processed == 4
+
+    def test_batches(cls):
+        batches = []
+
+        def record(batch):
+            batches.append(list(batch))
+            return [x for x in batch if x % 5]
+
+        stages = [Stage('batch', record, workers=2, batch_size=4)]
+        results = Pipeline(range(10), stages, report_interval=None).run()
+        assert sorted(x for batch in batches for x in batch) == list(range(10))
+        assert all(len(batch) <= 4 for batch in batches)
+        assert sorted(results) == [1, 2, 3, 4, 6, 7, 8, 9]
+        assert stages[0].processed == 10
+
+    def test_backpressure(cls):
+        release = threading.Event()
+
+        def slow(x):
+            release.wait()
+            return x
+
+        stages = [Stage('fast', lambda x: x, queue_size=2), Stage('slow', slow, queue_size=3)]
+        pipeline = Pipeline(range(50), stages, report_interval=None)
+        thread = threading.Thread(target=pipeline.run)
+        thread.start()
+        try:
+            deadline = time.monotonic() + 5
+            while pipeline.depths() != {'fast': 2, 'slow': 3} and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert pipeline.depths() == {'fast': 2, 'slow': 3}
+        finally:
+            release.set()
+            thread.join()
+        assert len(pipeline.results) == 50
+        assert stages[1].max_depth <= 3
+
+
+class TestSendNotifications:
+    def stub(cls, monkeypatch, weather_data, failing_point=None):
+        store = [
+            {
+                'name': f'Rider {i}',
+                'email': f'rider{i}@example.com',
+                'home': [52.0 + i % 2, 5.0],
+                'dest': [52.1, 5.1],
+                'departure_time': 900,
+                'return_time': 1700,
+                'best_window': bool(i % 3),
+            }
+            for i in range(10)
+        ]
+        fetched = []
+        sent = []
+        archived = []
+
+        def fetch(point):
+            fetched.append(point)
+            if point == failing_point:
+                raise ValueError(point)
+            return weather_data
+
+        monkeypatch.setattr(get_and_send_forecasts, 'get_store', lambda: store)
+        monkeypatch.setattr(get_and_send_forecasts, 'get_secrets', lambda: {
+            'email_user': 'forecast@example.com', 'email_pass': 'secret'})
+        monkeypatch.setattr(get_and_send_forecasts, 'get_weather_data', fetch)
+        monkeypatch.setattr(get_and_send_forecasts, 'save_archive_chunk', archived.extend)
+
+        class Transport(MailTransport):
+            batch_size = 3
+
+            def send(self, messages):
+                sent.extend(messages)
+                return [SendResult(message.to_address, ok=True) for message in messages]
+
+        return store, fetched, sent, archived, Transport()
+
+    def test_send_notifications(cls, monkeypatch, weather_data):
+        store, fetched, sent, archived, transport = cls.stub(monkeypatch, weather_data)
+        get_and_send_forecasts.send_notifications(workers={'fetch': 3, 'send': 4}, transport=transport)
+
+        assert sorted(fetched) == [(52.05, 5.05), (52.55, 5.05)]
+        assert sorted(message.to_address for message in sent) == sorted(sub['email'] for sub in store)
+        assert all('BikeRideForecast' in message.mime for message in sent)
+        scores = [record for record in archived if record.leg != archive.LEG_FORECAST]
+        assert len(scores) == 10 * 2 + sum(sub['best_window'] for sub in store) * 2
+        forecasts = [record for record in archived if record.leg == archive.LEG_FORECAST]
+        assert len(forecasts) == 2 * len(weather_data['list'])
+        assert {(record.lat, record.lon) for record in forecasts} == {(52.05, 5.05), (52.55, 5.05)}
+
+    def test_raises_after_sending_the_rest(cls, monkeypatch, weather_data):
+        store, _, sent, archived, transport = cls.stub(monkeypatch, weather_data, failing_point=(52.55, 5.05))
+        with pytest.raises(RuntimeError, match='Failed to notify 5 subscriptions'):
+            get_and_send_forecasts.send_notifications(transport=transport)
+
+        assert sorted(message.to_address for message in sent) == sorted(sub['email'] for sub in store[::2])
+        assert {(record.lat, record.lon) for record in archived} == {(52.05, 5.05)}
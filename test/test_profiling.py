@@ -0,0 +1,76 @@
+import concurrent.futures
+import contextlib
+import pathlib
+import get_and_send_forecasts
+import profiling
+from pipeline import Pipeline, Stage
+
+
+def busy_work(x):
+    return sum(i * i for i in range(x))
+
+
+class TestProfiling:
+    def test_get_sample_rate(cls, monkeypatch):
+        monkeypatch.delenv(profiling.SAMPLE_RATE_ENV, raising=False)
+        assert profiling.get_sample_rate() == 0
+        assert profiling.get_sample_rate(True) == 1
+        assert profiling.get_sample_rate(False) == 0
+        assert profiling.get_sample_rate(0.25) == 0.25
+        assert profiling.get_sample_rate(7) == 1
+        monkeypatch.setenv(profiling.SAMPLE_RATE_ENV, '0.1')
+        assert profiling.get_sample_rate() == 0.1
+
+    def test_get_sample_rate_strings(cls, monkeypatch):
+        assert profiling.get_sample_rate('true') == 1
+        assert profiling.get_sample_rate(' True ') == 1
+        assert profiling.get_sample_rate('false') == 0
+        assert profiling.get_sample_rate('0.5') == 0.5
+        assert profiling.get_sample_rate('nan') == 0
+        assert profiling.get_sample_rate([1]) == 0
+        monkeypatch.setenv(profiling.SAMPLE_RATE_ENV, 'yes')
+        assert profiling.get_sample_rate() == 0
+
+    def test_maybe_profile_not_sampled(cls, tmp_path):
+        profiler = profiling.maybe_profile('test', str(tmp_path), sample_rate=0)
+        assert isinstance(profiler, contextlib.nullcontext)
+
+    def test_profiler_includes_pipeline_threads(cls, tmp_path):
+        with profiling.maybe_profile('test', str(tmp_path), sample_rate=True) as profiler:
+            Pipeline([1000] * 20, [Stage('busy', busy_work, workers=2)], report_interval=None).run()
+
+        assert profiler.location.startswith(str(tmp_path))
+        report = pathlib.Path(profiler.location).read_text()
+        assert 'busy_work' in report
+        assert '== Allocation sites ==' in report
+        assert profiling._active is None
+
+    def test_call_profiled_on_process(cls, tmp_path):
+        with profiling.Profiler('test', str(tmp_path), top=1000) as profiler:
+            with concurrent.futures.ProcessPoolExecutor(1) as executor:
+                result, stats = executor.submit(profiling.call_profiled, busy_work, 1000).result()
+            profiling.add_stats(stats)
+        assert result == busy_work(1000)
+        assert 'busy_work' in profiler.report
+
+    def test_defer_write(cls, tmp_path):
+        with profiling.maybe_profile('test', str(tmp_path), sample_rate=True, defer_write=True) as profiler:
+            busy_work(1000)
+        assert profiler.report is None
+        assert list(tmp_path.iterdir()) == []
+
+        profiler.write()
+        assert 'busy_work' in pathlib.Path(profiler.location).read_text()
+
+    def test_handler_profile_event(cls, monkeypatch, tmp_path):
+        monkeypatch.setattr(get_and_send_forecasts, 'send_notifications', lambda **kwargs: busy_work(1000))
+        get_and_send_forecasts.handler({'profile': False, 'profile_destination': str(tmp_path)}, None)
+        assert list(tmp_path.iterdir()) == []
+
+        get_and_send_forecasts.handler({'profile': True, 'profile_destination': str(tmp_path)}, None)
+        reports = list(tmp_path.iterdir())
+        assert len(reports) == 1
+        assert reports[0].name.startswith('lambda-')
+
+        get_and_send_forecasts.handler({'profile': 'sometimes', 'profile_destination': str(tmp_path)}, None)
+        assert len(list(tmp_path.iterdir())) == 1
@@ -0,0 +1,404 @@
+import archive
+import asyncio
+import boto3
+import concurrent.futures
+import json
+import pickle
+import profiling
+import pytest
+import threading
+import get_and_send_forecasts
+import server
+import tornado.httpclient
+from datetime import datetime
+from get_and_send_forecasts import (
+    Subscription,
+    Weather,
+    create_render_chunks,
+    get_midway_point,
+    render_chunk)
+from loadtest import LoadReport, run_load, start_server, stub_weather_data, stubbed_server, subscription_data
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    path = tmp_path / 'store.json'
+    with stubbed_server(path) as sent:
+        yield path, sent
+
+
+def run(requests, concurrency, mix, notify_interval=None):
+    async def go():
+        http_server, base_url = start_server()
+        try:
+            return await run_load(
+                base_url,
+                requests=requests,
+                concurrency=concurrency,
+                mix=mix,
+                notify_interval=notify_interval)
+        finally:
+            http_server.stop()
+    return asyncio.run(go())
+
+
+class TestLoadReport:
+    def test_percentile(cls):
+        report = LoadReport(
+            concurrency=1,
+            duration=2,
+            latencies={'health': [0.1 * i for i in range(1, 11)], 'subscription': []},
+            errors={'health': 1, 'subscription': 0})
+        assert report.requests == 10
+        assert report.requests_per_second == 5
+        assert report.error_rate == 0.1
+        assert report.percentile(50) == pytest.approx(0.5)
+        assert report.percentile(90, 'health') == pytest.approx(0.9)
+        assert report.percentile(100) == pytest.approx(1.0)
+        assert report.percentile(50, 'subscription') == 0
+
+
+class TestServerLoad:
+    def test_health(cls, store_path):
+        report = run(requests=100, concurrency=10, mix={'health': 1})
+        assert report.requests == 100
+        assert report.error_rate == 0
+
+    def test_no_subscriptions_lost(cls, store_path):
+        path, _ = store_path
+        report = run(requests=300, concurrency=50, mix={'health': 1, 'subscription': 2})
+        assert report.error_rate == 0
+        stored = json.loads(path.read_bytes())
+        assert len(stored) == report.subscriptions_sent
+        assert len({sub['email'] for sub in stored}) == len(stored)
+
+    def test_no_subscriptions_lost_while_notifying(cls, store_path):
+        path, sent = store_path
+        # a store big enough that rewriting it on every signup takes a while,
+        # with its subscriptions fingerprinted so that each run is quick
+        seeded = [{**subscription_data(-i), 'name': 'x' * 20000} for i in range(1, 61)]
+        path.write_text(json.dumps(seeded))
+        asyncio.run(server.send_notifications())
+
+        # notification runs back to back on another thread, each reading the
+        # store on a worker thread while the signups rewrite it
+        stop = threading.Event()
+        runs = []
+        errors = []
+
+        def notify():
+            while not stop.is_set():
+                try:
+                    asyncio.run(server.send_notifications())
+                except Exception as exc:
+                    errors.append(exc)
+                runs.append(1)
+
+        notifier = threading.Thread(target=notify)
+        notifier.start()
+        try:
+            report = run(requests=200, concurrency=50, mix={'subscription': 1})
+        finally:
+            stop.set()
+            notifier.join()
+        assert report.error_rate == 0
+        assert len(runs) > 10
+        assert errors == []
+        assert sent
+        stored = json.loads(path.read_bytes())
+        assert len(stored) == len(seeded) + report.subscriptions_sent
+        assert report.subscriptions_sent == 200
+
+    def test_failed_notification_runs_are_counted(cls, store_path, monkeypatch):
+        async def fail(executor=None):
+            raise RuntimeError('boom')
+
+        monkeypatch.setattr(server, 'send_notifications', fail)
+        report = run(requests=100, concurrency=10, mix={'health': 1}, notify_interval=0)
+        assert report.notification_runs > 0
+        assert report.notification_errors == report.notification_runs
+
+
+class TestWriteAtomically:
+    def test_replaces_without_leftovers(cls, tmp_path):
+        path = tmp_path / 'store.json'
+        path.write_text('old')
+        server.write_atomically(path, b'new')
+        assert path.read_bytes() == b'new'
+        assert [child.name for child in tmp_path.iterdir()] == ['store.json']
+
+
+class TestProfileEndpoint:
+    def post(cls, headers=None):
+        async def go():
+            http_server, base_url = start_server()
+            client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+            try:
+                response = await client.fetch(
+                    f'{base_url}/profile', method='POST', body='', headers=headers, raise_error=False)
+                return response.code
+            finally:
+                client.close()
+                http_server.stop()
+        return asyncio.run(go())
+
+    def test_requires_token(cls, monkeypatch):
+        monkeypatch.setattr(server, 'profile_next_run', False)
+        monkeypatch.setattr(server, 'PROFILE_TOKEN', None)
+        assert cls.post({'X-Profile-Token': ''}) == 403
+
+        monkeypatch.setattr(server, 'PROFILE_TOKEN', 'secret')
+        assert cls.post() == 403
+        assert cls.post({'X-Profile-Token': 'wrong'}) == 403
+        assert not server.profile_next_run
+
+        assert cls.post({'X-Profile-Token': 'secret'}) == 200
+        assert server.profile_next_run
+
+
+class TestNotificationWorker:
+    def test_render_chunks(cls):
+        subs = [Subscription.from_data(subscription_data(i)) for i in range(120)]
+        forecasts = {
+            get_midway_point(sub.home, sub.dest): Weather.list_from_weather_data(stub_weather_data(None))
+            for sub in subs
+        }
+        chunks = create_render_chunks(subs, forecasts, datetime.today(), 'forecast@example.com', chunk_size=5)
+        assert sum(len(chunk.sub_rows) for chunk in chunks) == 120
+        for chunk in chunks:
+            assert len(chunk.sub_rows) <= 5
+            assert all(get_midway_point(row[2], row[3]) == chunk.midway_point for row in chunk.sub_rows)
+
+        chunk = pickle.loads(pickle.dumps(chunks[0]))
+        messages = render_chunk(chunk)
+        assert [message.to_address for message in messages] == [row[1] for row in chunks[0].sub_rows]
+        assert all('BikeRideForecast' in message.message.mime for message in messages)
+        assert all(len(message.archive_records) == 2 for message in messages)
+
+    def test_render_chunk_min_change(cls):
+        subs = [Subscription.from_data(subscription_data(i)) for i in (0, 10)]
+        point = get_midway_point(subs[0].home, subs[0].dest)
+        forecasts = {point: Weather.list_from_weather_data(stub_weather_data(None))}
+        day = datetime.today()
+        totals = [
+            (message.departure_total, message.return_total)
+            for message in render_chunk(create_render_chunks(subs, forecasts, day, 'forecast@example.com')[0])
+        ]
+
+        chunk = create_render_chunks(
+            subs, forecasts, day, 'forecast@example.com',
+            last_totals={
+                subs[0].key(): (totals[0][0] + 0.5, totals[0][1]),
+                subs[1].key(): (totals[1][0] + 3, totals[1][1]),
+            },
+            min_change=1)[0]
+        messages = render_chunk(chunk)
+        assert messages[0].message is None
+        assert messages[1].message is not None
+
+    def test_render_chunk_skips_unchanged(cls):
+        subs = [Subscription.from_data(subscription_data(i)) for i in (0, 10)]
+        point = get_midway_point(subs[0].home, subs[0].dest)
+        forecasts = {point: Weather.list_from_weather_data(stub_weather_data(None))}
+        day = datetime.today()
+        first = render_chunk(create_render_chunks(subs, forecasts, day, 'forecast@example.com')[0])
+        chunk = create_render_chunks(
+            subs, forecasts, day, 'forecast@example.com',
+            last_fingerprints={subs[0].key(): first[0].fingerprint, subs[1].key(): 'stale'})[0]
+        messages = render_chunk(chunk)
+        assert [message.to_address for message in messages] == [subs[1].email]
+        assert messages[0].fingerprint == first[1].fingerprint
+
+    def test_send_notifications_on_processes(cls, store_path):
+        path, sent = store_path
+        path.write_text(json.dumps([subscription_data(i) for i in range(200)]))
+
+        async def go():
+            with concurrent.futures.ProcessPoolExecutor(2) as executor:
+                await server.send_notifications(executor)
+
+        asyncio.run(go())
+        assert sorted(sent) == sorted(subscription_data(i)['email'] for i in range(200))
+
+    def test_profile_includes_processes(cls, store_path, tmp_path):
+        path, _ = store_path
+        path.write_text(json.dumps([subscription_data(i) for i in range(20)]))
+
+        async def go():
+            with concurrent.futures.ProcessPoolExecutor(2) as executor:
+                with profiling.Profiler('test', str(tmp_path / 'profiles'), top=1000) as profiler:
+                    await server.send_notifications(executor, profile=True)
+            return profiler
+
+        profiler = asyncio.run(go())
+        assert 'render_chunk' in profiler.report
+        assert 'create_fingerprint' in profiler.report
+
+
+class TestArchive:
+    def test_archives_forecasts_once_per_day(cls, store_path):
+        path, _ = store_path
+        path.write_text(json.dumps([subscription_data(i) for i in range(20)]))
+        asyncio.run(server.send_notifications())
+        asyncio.run(server.send_notifications())
+
+        records = list(archive.Archive(path.with_name('archive')).query())
+        forecasts = [record for record in records if record.leg == archive.LEG_FORECAST]
+        points = {get_midway_point(sub['home'], sub['dest']) for sub in map(subscription_data, range(20))}
+        assert len(forecasts) == len(points) * 40
+        assert {(record.lat, record.lon) for record in forecasts} == points
+        # the second run skipped every unchanged subscriber
+        assert len(records) - len(forecasts) == 20 * 2
+
+
+class TestChangeDetection:
+    def run(cls, **kwargs):
+        asyncio.run(server.send_notifications(**kwargs))
+
+    def test_skips_unchanged(cls, store_path):
+        path, sent = store_path
+        path.write_text(json.dumps([subscription_data(i) for i in range(20)]))
+        cls.run()
+        assert len(sent) == 20
+
+        cls.run()
+        assert len(sent) == 20
+
+        path.write_text(json.dumps([subscription_data(i) for i in range(21)]))
+        cls.run()
+        assert sent[20:] == [subscription_data(20)['email']]
+
+    def test_min_change(cls, store_path, monkeypatch):
+        path, sent = store_path
+        path.write_text(json.dumps([subscription_data(i) for i in range(5)]))
+        cls.run()
+        assert len(sent) == 5
+
+        def breezier(coords):
+            data = stub_weather_data(coords)
+            for item in data['list']:
+                item['wind']['speed'] += 1
+            return data
+
+        monkeypatch.setattr(server, 'get_weather_data', breezier)
+        cls.run(min_change=5)
+        assert len(sent) == 5
+        fingerprints = json.loads(path.with_name('fingerprints.json').read_bytes())
+        assert len(fingerprints) == 5
+
+        # the inputs were already seen, so nothing is rescored either
+        cls.run()
+        assert len(sent) == 5
+
+        def stormy(coords):
+            data = stub_weather_data(coords)
+            for item in data['list']:
+                item['rain'] = {'3h': 4}
+            return data
+
+        monkeypatch.setattr(server, 'get_weather_data', stormy)
+        cls.run(min_change=5)
+        assert len(sent) == 10
+
+    def test_failed_send_is_retried(cls, store_path, monkeypatch):
+        path, sent = store_path
+        path.write_text(json.dumps([subscription_data(i) for i in range(3)]))
+        monkeypatch.setattr(server.mail.SMTPTransport, 'send', lambda self, messages: [
+            server.mail.SendResult(message.to_address, ok=False, error='down')
+            for message in messages
+        ])
+        cls.run()
+        assert sent == []
+
+        monkeypatch.undo()
+        with stubbed_server(path) as sent:
+            cls.run()
+            assert len(sent) == 3
+
+    def test_failing_subscriptions_are_isolated(cls, store_path, monkeypatch):
+        path, sent = store_path
+        invalid = {**subscription_data(5), 'best_window': True, 'departure_window': ['7am', '9am']}
+        path.write_text(json.dumps([subscription_data(i) for i in range(5)] + [invalid]))
+        create = get_and_send_forecasts.ScoredTrip.create.__func__
+
+        def flaky(klass, trip, day):
+            if trip.sub.email == subscription_data(1)['email']:
+                raise ValueError('bad subscription')
+            return create(klass, trip, day)
+
+        monkeypatch.setattr(get_and_send_forecasts.ScoredTrip, 'create', classmethod(flaky))
+        cls.run()
+        assert sorted(sent) == sorted(subscription_data(i)['email'] for i in (0, 2, 3, 4))
+
+        # the failed one is retried next time
+        monkeypatch.undo()
+        with stubbed_server(path) as sent:
+            cls.run()
+            assert sent == [subscription_data(1)['email']]
+
+    def test_failed_fetch_skips_only_its_point(cls, store_path, monkeypatch):
+        path, sent = store_path
+        path.write_text(json.dumps([subscription_data(i) for i in range(20)]))
+        subs = [Subscription.from_data(subscription_data(i)) for i in range(20)]
+        failing = get_midway_point(subs[3].home, subs[3].dest)
+
+        def fetch(point):
+            if point == failing:
+                raise ConnectionError('weather API down')
+            return stub_weather_data(point)
+
+        monkeypatch.setattr(server, 'get_weather_data', fetch)
+        cls.run()
+        assert sorted(sent) == sorted(
+            sub.email for sub in subs if get_midway_point(sub.home, sub.dest) != failing)
+
+    def test_ses_transport(cls, store_path, monkeypatch):
+        moto = pytest.importorskip('moto')
+        path, sent = store_path
+        path.write_text(json.dumps([subscription_data(i) for i in range(60)]))
+        monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+        monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+        monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+        monkeypatch.setattr(server, 'MAIL_TRANSPORT', 'ses')
+        with moto.mock_aws():
+            ses = boto3.client('ses')
+            ses.verify_email_identity(EmailAddress='loadtest@example.com')
+            cls.run()
+            assert ses.get_send_quota()['SentLast24Hours'] == 60
+        assert sent == []
+        assert len(json.loads(path.with_name('fingerprints.json').read_bytes())) == 60
+
+    def test_routes_sharing_an_email(cls, store_path):
+        path, sent = store_path
+        work = subscription_data(0)
+        gym = {**subscription_data(5), 'email': work['email']}
+        path.write_text(json.dumps([work, gym]))
+        cls.run()
+        assert sent == [work['email']] * 2
+        fingerprints = json.loads(path.with_name('fingerprints.json').read_bytes())
+        assert len(fingerprints) == 2
+
+        cls.run()
+        assert len(sent) == 2
+
+    def test_raising_batch_keeps_sent_fingerprints(cls, store_path, monkeypatch):
+        path, sent = store_path
+        path.write_text(json.dumps([subscription_data(i) for i in range(25)]))
+        send = server.mail.SMTPTransport.send
+        calls = []
+
+        def flaky(self, messages):
+            calls.append(len(messages))
+            if len(calls) == 2:
+                raise RuntimeError('boom')
+            return send(self, messages)
+
+        monkeypatch.setattr(server.mail.SMTPTransport, 'send', flaky)
+        cls.run()
+        assert calls == [20, 5]
+        assert len(sent) == 20
+
+        monkeypatch.setattr(server.mail.SMTPTransport, 'send', send)
+        cls.run()
+        assert len(sent) == 25
+        assert sorted(sent) == sorted(subscription_data(i)['email'] for i in range(25))